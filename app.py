@@ -1,13 +1,66 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+from flask import Flask, Request, Response, render_template, request, jsonify, session, redirect, url_for, send_from_directory, make_response
 from functools import wraps
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+import base64
+import bisect
+import codecs
+import csv
+import errno
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from dotenv import load_dotenv
 from urllib.parse import urlencode, parse_qs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Pillow нужен только для миниатюр обложек и копий фонов; без него файлы хранятся как есть
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# brotli необязателен; без него книги сжимаются только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# google-auth нужен для локальной проверки id_token от Google;
+# без него данные пользователя запрашиваются через userinfo
+try:
+    from google.auth import jwt as google_jwt
+except ImportError:
+    google_jwt = None
+
+# fcntl есть только в Unix; без него файлы блокируются только внутри процесса
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Загрузка переменных окружения из .env
 load_dotenv()
@@ -24,28 +77,116 @@ if is_vercel:
     USERS_PATH = '/tmp/users.json'
     BOOKS_DIR = '/tmp/books'
     BACKGROUNDS_DIR = '/tmp/backgrounds'
+    COVERS_DIR = '/tmp/covers'
+    BOOK_INDEX_DIR = '/tmp/book_index'
+    BOOK_BLOBS_DIR = '/tmp/book_blobs'
+    JOBS_DIR = '/tmp/jobs'
+    UPLOADS_DIR = '/tmp/uploads'
+    SQLITE_DB_PATH = '/tmp/library.sqlite3'
 else:
     # Для localhost
     DB_PATH = 'database.json'
     USERS_PATH = 'users.json'
     BOOKS_DIR = 'books'
     BACKGROUNDS_DIR = 'static/backgrounds'
+    COVERS_DIR = 'covers'
+    BOOK_INDEX_DIR = 'book_index'
+    BOOK_BLOBS_DIR = 'book_blobs'
+    JOBS_DIR = 'jobs'
+    UPLOADS_DIR = 'uploads'
+    SQLITE_DB_PATH = 'library.sqlite3'
 
 # Создаем папки
 if not os.path.exists(BOOKS_DIR):
     os.makedirs(BOOKS_DIR)
 if not os.path.exists(BACKGROUNDS_DIR):
     os.makedirs(BACKGROUNDS_DIR)
+if not os.path.exists(COVERS_DIR):
+    os.makedirs(COVERS_DIR)
+if not os.path.exists(BOOK_INDEX_DIR):
+    os.makedirs(BOOK_INDEX_DIR)
+if not os.path.exists(BOOK_BLOBS_DIR):
+    os.makedirs(BOOK_BLOBS_DIR)
+if not os.path.exists(JOBS_DIR):
+    os.makedirs(JOBS_DIR)
+if not os.path.exists(UPLOADS_DIR):
+    os.makedirs(UPLOADS_DIR)
+# Завершенные фоновые задачи (см. save_job)
+FINISHED_JOBS_DIR = os.path.join(JOBS_DIR, 'done')
+if not os.path.exists(FINISHED_JOBS_DIR):
+    os.makedirs(FINISHED_JOBS_DIR)
+# Уменьшенные копии загруженных фонов
+BACKGROUND_VARIANTS_DIR = os.path.join(BACKGROUNDS_DIR, 'variants')
+if not os.path.exists(BACKGROUND_VARIANTS_DIR):
+    os.makedirs(BACKGROUND_VARIANTS_DIR)
+
+# Адреса Google OAuth (переопределяются, например, для локального тестового сервера)
+GOOGLE_AUTH_URL = os.getenv('GOOGLE_AUTH_URL', 'https://accounts.google.com/o/oauth2/v2/auth')
+GOOGLE_TOKEN_URL = os.getenv('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GOOGLE_USERINFO_URL = os.getenv('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v2/userinfo')
+GOOGLE_CERTS_URL = os.getenv('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# Таймауты внешних HTTP-запросов: (соединение, чтение) в секундах
+HTTP_TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05)), float(os.getenv('HTTP_READ_TIMEOUT', 10)))
+
+# Хранилище книг, пользователей и настроек: 'json' (файлы) или 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').strip().lower()
 
 # Настройки загрузки файлов
 ALLOWED_BOOK_EXTENSIONS = {'txt'}
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'svg', 'webp'}
 UPLOAD_FOLDER = BOOKS_DIR
 MAX_UPLOAD_SIZE = 16 * 1024 * 1024  # 16MB
+# Загрузка по частям: размер части (меньше MAX_UPLOAD_SIZE), предел файла и срок жизни незавершенной загрузки
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNKED_UPLOAD_SIZE = int(os.getenv('MAX_CHUNKED_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+UPLOAD_EXPIRE_SECONDS = 24 * 60 * 60
+# Предел ZIP-архива для массового импорта (POST /api/books/import)
+MAX_IMPORT_ARCHIVE_SIZE = int(os.getenv('MAX_IMPORT_ARCHIVE_SIZE', 2 * 1024 * 1024 * 1024))
+MAX_BOOKS_PAGE_SIZE = 500  # Максимум книг на одну страницу /api/books
+DEFAULT_COVER = 'https://via.placeholder.com/150'
+COVER_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # 1 год
+MAX_PARAGRAPHS_PAGE_SIZE = 500  # Максимум абзацев за один запрос текста
+BOOK_WORDS_PER_PAGE = 300  # Слов на страницу (как wordsPerPage в reader.html)
+BOOK_STREAM_CHUNK_SIZE = 64 * 1024  # Размер блока при потоковой отдаче текста
+BOOK_MMAP_MIN_SIZE = 1024 * 1024  # Файлы книг от 1MB читаются через mmap
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))  # Потоков фоновой обработки книг
+# Кэш готовых ответов /api/books/<id>/text: общий лимит и максимум на одну книгу
+BOOK_TEXT_CACHE_MAX_BYTES = int(os.getenv('BOOK_TEXT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+BOOK_TEXT_CACHE_MAX_ITEM_BYTES = int(os.getenv('BOOK_TEXT_CACHE_MAX_ITEM_BYTES', 8 * 1024 * 1024))
+# Загруженные фоны: ширины уменьшенных копий, ширина по умолчанию
+# (если клиент не сообщил размер экрана) и качество сжатия
+BACKGROUND_WIDTHS = (640, 1280, 1920, 2560)
+BACKGROUND_DEFAULT_WIDTH = 1920
+BACKGROUND_QUALITY = {'webp': 80, 'jpg': 82}
+# Ширина миниатюр обложек (в пикселях)
+COVER_THUMB_SIZES = {'small': 150, 'medium': 400}
+COVER_MIME_EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/jpg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+    'image/svg+xml': 'svg'
+}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
+# Свой предел размера тела для отдельных маршрутов (по имени view-функции):
+# архив с тысячами книг для импорта больше общего MAX_UPLOAD_SIZE.
+# В Flask 3.0 request.max_content_length только для чтения, поэтому через свой класс запроса
+ROUTE_MAX_CONTENT_LENGTH = {'import_books': MAX_IMPORT_ARCHIVE_SIZE}
+
+class LibraryRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint in ROUTE_MAX_CONTENT_LENGTH:
+            return ROUTE_MAX_CONTENT_LENGTH[self.endpoint]
+        return super().max_content_length
+
+app.request_class = LibraryRequest
+
 def allowed_file(filename, extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
@@ -60,31 +201,35 @@ def init_db():
         }
         save_db(default_data)
 
-# Инициализация файла пользователей
-def init_users():
-    if not os.path.exists(USERS_PATH):
-        default_users = []
-        save_users(default_users)
-
 # Чтение пользователей
 def read_users():
-    init_users()
-    try:
-        with open(USERS_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return []
+    return storage.load_users()
 
 # Сохранение пользователей
 def save_users(users):
     try:
-        with open(USERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        storage.save_users(users)
         return True
     except Exception as e:
         print(f'Ошибка сохранения пользователей: {e}')
         return False
 
+# Найти пользователя по имени (None, если нет)
+def get_user(username):
+    return storage.get_user(username)
+
+# Найти пользователя по email (None, если нет)
+def get_user_by_email(email):
+    return storage.get_user_by_email(email)
+
+# Добавить пользователя; False, если имя уже занято
+def create_user(user):
+    return storage.create_user(user)
+
+# Изменить поля пользователя (в том числе имя); None, если пользователя нет
+def update_user_fields(username, changes):
+    return storage.update_user(username, changes)
+
 # Чтение базы данных
 def read_db():
     init_db()
@@ -96,20 +241,477 @@ def read_db():
 
 # Сохранение базы данных
 def save_db(data):
-    with open(DB_PATH, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with lock_file(DB_PATH):
+        write_json_atomic(DB_PATH, data)
 
-# Получить пользователей из .env
+# Запись JSON через временный файл и переименование: читатели видят
+# либо старую, либо новую версию целиком
+def write_json_atomic(path, data, indent=None):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# То же для двоичных данных: файл, названный по хэшу содержимого,
+# никогда не виден (и не остается после сбоя) недописанным
+def write_bytes_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# Межпроцессная блокировка файла (через <путь>.lock). Без fcntl (Windows)
+# файл защищен только блокировками внутри процесса
+@contextmanager
+def lock_file(path):
+    with open(path + '.lock', 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+# JSON файл, который меняют несколько потоков и процессов.
+# read() отдает разобранные данные из кэша, пока файл не изменился.
+# mutate(fn) ставит изменение в очередь; первый поток, захвативший
+# commit_lock, под блокировкой файла перечитывает его, применяет все
+# накопившиеся изменения и записывает результат одним атомарным
+# переименованием (групповая запись). fn получает поверхностную копию
+# данных и не должна менять вложенные объекты на месте
+class JsonFile:
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.pending = []
+        self.stamp = None
+        self.data = None
+    
+    # Атомарная замена создает новый inode, поэтому он входит в отметку
+    def get_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    
+    def read(self):
+        with self.lock:
+            stamp = self.get_stamp()
+            if self.data is None or stamp != self.stamp:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self.data = json.load(f)
+                except (OSError, ValueError):
+                    self.data = self.default()
+                self.stamp = stamp
+            return self.data
+    
+    def mutate(self, fn):
+        entry = {'fn': fn, 'done': False, 'result': None, 'error': None}
+        with self.lock:
+            self.pending.append(entry)
+        with self.commit_lock:
+            if not entry['done']:
+                self.commit()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+    
+    def commit(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        try:
+            with lock_file(self.path):
+                current = self.read()
+                data = list(current) if isinstance(current, list) else dict(current)
+                for entry in batch:
+                    try:
+                        entry['result'] = entry['fn'](data)
+                    except Exception as e:
+                        entry['error'] = e
+                write_json_atomic(self.path, data)
+                with self.lock:
+                    self.data = data
+                    self.stamp = self.get_stamp()
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = entry['error'] or e
+        finally:
+            for entry in batch:
+                entry['done'] = True
+
+# Чтение файла метаданных книги
+def read_book_meta(meta_path):
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# Хранилище в JSON файлах: метаданные книг в BOOKS_DIR/<id>.json,
+# пользователи в USERS_PATH, настройки в DB_PATH
+class JsonStorage:
+    name = 'json'
+    
+    def __init__(self):
+        self.users_file = JsonFile(USERS_PATH, list)
+        self.db_file = JsonFile(DB_PATH, lambda: {'settings': {'background': None, 'backgroundType': 'default'}})
+        self.users_index = (None, {}, {})
+    
+    def get_book_meta_path(self, book_id):
+        return os.path.join(BOOKS_DIR, book_id + '.json')
+    
+    def load_books(self):
+        books = {}
+        if os.path.exists(BOOKS_DIR):
+            for filename in os.listdir(BOOKS_DIR):
+                if filename.endswith('.json'):
+                    try:
+                        book = read_book_meta(os.path.join(BOOKS_DIR, filename))
+                    except Exception as e:
+                        print(f'Ошибка чтения файла {filename}: {e}')
+                        continue
+                    books[book.get('id') or filename[:-len('.json')]] = book
+        return books
+    
+    def get_book(self, book_id):
+        try:
+            return read_book_meta(self.get_book_meta_path(book_id))
+        except (OSError, ValueError):
+            return None
+    
+    # Через временный файл и переименование: меняется mtime папки книг,
+    # и другие процессы видят, что каталог устарел (см. get_catalog_stamp)
+    def save_book(self, book):
+        write_json_atomic(self.get_book_meta_path(book['id']), book, indent=2)
+    
+    # Удалить метаданные книги; возвращает удаленные метаданные или None
+    def delete_book(self, book_id):
+        book = self.get_book(book_id)
+        if book is not None:
+            os.remove(self.get_book_meta_path(book_id))
+        return book
+    
+    # Метаданные лежат в BOOKS_DIR, их изменения видны по mtime папки
+    def books_version(self):
+        return None
+    
+    # Пользователи кэшируются вместе с индексами по имени и email;
+    # индекс перестраивается, когда JsonFile перечитал или записал файл
+    def get_users_index(self):
+        users = self.users_file.read()
+        index = self.users_index
+        if index[0] is not users:
+            positions = {}
+            by_email = {}
+            for i, user in enumerate(users):
+                positions.setdefault(user.get('username'), i)
+                if user.get('email'):
+                    by_email.setdefault(user['email'], i)
+            index = self.users_index = (users, positions, by_email)
+        return index
+    
+    # Копии, чтобы изменения вызывающего кода не попадали в кэш
+    def load_users(self):
+        return [dict(user) for user in self.users_file.read()]
+    
+    def save_users(self, users):
+        users = [dict(user) for user in users]
+        
+        def replace_all(data):
+            data[:] = users
+        self.users_file.mutate(replace_all)
+    
+    def get_user(self, username):
+        users, positions, by_email = self.get_users_index()
+        position = positions.get(username)
+        return dict(users[position]) if position is not None else None
+    
+    def get_user_by_email(self, email):
+        users, positions, by_email = self.get_users_index()
+        position = by_email.get(email)
+        return dict(users[position]) if position is not None else None
+    
+    def create_user(self, user):
+        user = dict(user)
+        
+        def append(users):
+            if any(existing.get('username') == user['username'] for existing in users):
+                return False
+            users.append(user)
+            return True
+        return self.users_file.mutate(append)
+    
+    def update_user(self, username, changes):
+        def update(users):
+            for i, existing in enumerate(users):
+                if existing.get('username') == username:
+                    users[i] = dict(existing, **changes)
+                    return dict(users[i])
+            return None
+        return self.users_file.mutate(update)
+    
+    def get_settings(self):
+        return dict(self.db_file.read().get('settings', {'background': None, 'backgroundType': 'default'}))
+    
+    def settings_version(self):
+        return self.db_file.get_stamp()
+    
+    def update_settings(self, changes):
+        def update(db):
+            db['settings'] = dict(db.get('settings') or {}, **changes)
+            return dict(db['settings'])
+        return self.db_file.mutate(update)
+
+# Хранилище в SQLite (режим WAL): книги, пользователи и настройки в таблицах
+# с индексами, запись меняет одну строку. Соединение - свое на каждый поток
+class SqliteStorage:
+    name = 'sqlite'
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS books (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            author TEXT,
+            genre TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS books_title ON books (title);
+        CREATE INDEX IF NOT EXISTS books_author ON books (author);
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            email TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.executescript(self.SCHEMA)
+    
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+    
+    def get_meta(self, key):
+        row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, conn, key, value):
+        conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                     'ON CONFLICT (key) DO UPDATE SET value = excluded.value', (key, value))
+    
+    # Счетчик изменений книг: по нему другие процессы узнают, что каталог устарел
+    def bump_books_version(self, conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('books_version', 1) "
+                     "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+    
+    def load_books(self):
+        rows = self.connect().execute('SELECT id, data FROM books').fetchall()
+        return {book_id: json.loads(data) for book_id, data in rows}
+    
+    def get_book(self, book_id):
+        row = self.connect().execute('SELECT data FROM books WHERE id = ?', (book_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def insert_book(self, conn, book):
+        conn.execute(
+            'INSERT INTO books (id, title, author, genre, data) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET title = excluded.title, author = excluded.author, '
+            'genre = excluded.genre, data = excluded.data',
+            (book['id'], book.get('title'), book.get('author'), book.get('genre'),
+             json.dumps(book, ensure_ascii=False))
+        )
+    
+    def save_book(self, book):
+        with self.connect() as conn:
+            self.insert_book(conn, book)
+            self.bump_books_version(conn)
+    
+    def delete_book(self, book_id):
+        with self.connect() as conn:
+            row = conn.execute('SELECT data FROM books WHERE id = ?', (book_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+            self.bump_books_version(conn)
+        return json.loads(row[0])
+    
+    def books_version(self):
+        return self.get_meta('books_version')
+    
+    def load_users(self):
+        rows = self.connect().execute('SELECT data FROM users ORDER BY rowid').fetchall()
+        return [json.loads(data) for data, in rows]
+    
+    def insert_user(self, conn, user):
+        conn.execute(
+            'INSERT INTO users (username, email, data) VALUES (?, ?, ?) '
+            'ON CONFLICT (username) DO UPDATE SET email = excluded.email, data = excluded.data',
+            (user['username'], user.get('email'), json.dumps(user, ensure_ascii=False))
+        )
+    
+    def save_users(self, users):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM users')
+            for user in users:
+                self.insert_user(conn, user)
+    
+    def get_user(self, username):
+        row = self.connect().execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def get_user_by_email(self, email):
+        row = self.connect().execute('SELECT data FROM users WHERE email = ? ORDER BY rowid LIMIT 1',
+                                     (email,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def create_user(self, user):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO users (username, email, data) VALUES (?, ?, ?) ON CONFLICT (username) DO NOTHING',
+                (user['username'], user.get('email'), json.dumps(user, ensure_ascii=False))
+            )
+        return cursor.rowcount == 1
+    
+    def update_user(self, username, changes):
+        conn = self.connect()
+        with conn:
+            # Блокировка на запись до чтения: чтение и запись - одна транзакция
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+            if row is None:
+                return None
+            user = dict(json.loads(row[0]), **changes)
+            if user['username'] != username:
+                conn.execute('UPDATE users SET username = ? WHERE username = ?', (user['username'], username))
+            self.insert_user(conn, user)
+        return user
+    
+    def get_settings(self):
+        rows = self.connect().execute('SELECT key, value FROM settings').fetchall()
+        if not rows:
+            return {'background': None, 'backgroundType': 'default'}
+        return {key: json.loads(value) for key, value in rows}
+    
+    def update_settings(self, changes):
+        with self.connect() as conn:
+            conn.executemany(
+                'INSERT INTO settings (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in changes.items()]
+            )
+            self.bump_settings_version(conn)
+        return self.get_settings()
+    
+    def bump_settings_version(self, conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('settings_version', 1) "
+                     "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+    
+    def settings_version(self):
+        return self.get_meta('settings_version')
+    
+    # Однократный перенос данных из JSON файлов (сами файлы не удаляются)
+    def migrate_from_json(self, source):
+        if self.get_meta('migrated_from_json'):
+            return
+        books = source.load_books()
+        users = source.load_users() if os.path.exists(USERS_PATH) else []
+        settings = read_db().get('settings') if os.path.exists(DB_PATH) else None
+        with self.connect() as conn:
+            for book_id, book in books.items():
+                self.insert_book(conn, dict(book, id=book_id))
+            for user in users:
+                if user.get('username'):
+                    self.insert_user(conn, user)
+            if settings:
+                conn.execute('DELETE FROM settings')
+                conn.executemany('INSERT INTO settings (key, value) VALUES (?, ?)',
+                                 [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()])
+            self.bump_books_version(conn)
+            self.bump_settings_version(conn)
+            self.set_meta(conn, 'migrated_from_json', str(time.time()))
+        print(f'Данные перенесены в SQLite: книг {len(books)}, пользователей {len(users)}')
+
+def create_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        sqlite_storage = SqliteStorage(SQLITE_DB_PATH)
+        sqlite_storage.migrate_from_json(JsonStorage())
+        return sqlite_storage
+    if STORAGE_BACKEND != 'json':
+        print(f'Неизвестное хранилище {STORAGE_BACKEND}, используются JSON файлы')
+    return JsonStorage()
+
+storage = create_storage()
+
+# Пользователи из .env (LIBRARY_USERS=имя:пароль,...) разбираются один раз.
+# Пароли хранятся только как HMAC с ключом процесса и сравниваются
+# за постоянное время. SIGHUP перечитывает .env без перезапуска
+_env_users_key = os.urandom(32)
+_env_users = {}  # имя -> HMAC пароля
+
+def env_password_digest(password):
+    return hmac.new(_env_users_key, password.encode('utf-8'), hashlib.sha256).digest()
+
+def load_env_users():
+    global _env_users
+    users = {}
+    for pair in os.getenv('LIBRARY_USERS', '').split(','):
+        pair = pair.strip()
+        if ':' in pair:
+            username, password = pair.split(':', 1)
+            users.setdefault(username.strip(), env_password_digest(password.strip()))
+    _env_users = users
+
+def is_env_user(username):
+    return username in _env_users
+
+def check_env_user_password(username, password):
+    digest = _env_users.get(username)
+    return digest is not None and hmac.compare_digest(digest, env_password_digest(password))
+
+# Получить пользователей из .env (без паролей)
 def get_users_from_env():
-    users_env = os.getenv('LIBRARY_USERS', '')
-    users = []
-    if users_env:
-        for pair in users_env.split(','):
-            pair = pair.strip()
-            if ':' in pair:
-                username, password = pair.split(':', 1)
-                users.append({'username': username.strip(), 'password': password.strip()})
-    return users
+    return [{'username': username} for username in _env_users]
+
+def reload_env_users(signum=None, frame=None):
+    load_dotenv(override=True)
+    load_env_users()
+    print(f'Пользователи из .env перечитаны: {len(_env_users)}')
+
+load_env_users()
+# Обработчик сигнала можно поставить только из главного потока (и не на Windows)
+if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, reload_env_users)
 
 # Получить доступные фоны
 def get_available_backgrounds():
@@ -122,919 +724,1713 @@ def get_available_backgrounds():
     
     return [bg.strip() for bg in backgrounds.split(',') if bg.strip()]
 
-# Проверка авторизации админа
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not session.get('is_admin'):
-            return jsonify({'error': 'Требуется авторизация администратора'}), 403
-        return f(*args, **kwargs)
-    return decorated_function
-
-# Проверка является ли пользователь админом
-def is_admin():
-    admin_username = os.getenv('ADMIN_USERNAME', 'admin')
-    return session.get('username') == admin_username
-
-# Главная страница (для всех)
-@app.route('/')
-def index():
-    return render_template('main.html')
-
-# Админ панель
-@app.route('/admin')
-def admin_panel():
-    return render_template('index.html')
-
-# Страница управления пользователями (только для админа)
-@app.route('/admin/users')
-def admin_users():
-    return render_template('users.html')
-
-# Публичная страница с книгами (для всех)
-@app.route('/books')
-def public_books():
-    return render_template('public.html')
-
-# API: Получить все книги (публичный доступ)
-@app.route('/api/books', methods=['GET'])
-def get_books():
-    # Загружаем книги из папки books
-    books = []
-    if os.path.exists(BOOKS_DIR):
-        for filename in os.listdir(BOOKS_DIR):
-            if filename.endswith('.json'):
-                file_path = os.path.join(BOOKS_DIR, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        book = json.load(f)
-                        books.append(book)
-                except Exception as e:
-                    print(f'Ошибка чтения файла {filename}: {e}')
-    
-    # Поиск по запросу
-    search_query = request.args.get('search', '').lower()
-    if search_query:
-        filtered_books = []
-        for book in books:
-            title = book.get('title', '').lower()
-            author = book.get('author', '').lower()
-            genre = book.get('genre', '').lower()
-            description = book.get('description', '').lower()
-            
-            if (search_query in title or 
-                search_query in author or 
-                search_query in genre or 
-                search_query in description):
-                filtered_books.append(book)
-        books = filtered_books
+# Статические файлы с хэшем содержимого в URL: /assets/<путь>.<хэш>.<расширение>.
+# Такие ответы кэшируются браузером навсегда; при изменении файла меняется URL.
+# Хэши считаются при запуске и пересчитываются, если у файла изменились mtime/размер
+ASSET_HASH_LENGTH = 12
+ASSET_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # 1 год
+_asset_manifest_lock = threading.Lock()
+_asset_manifest = {}  # путь в static -> (mtime_ns, размер, хэш)
+
+def get_file_fingerprint(file_path, manifest_key):
+    # Только обычные файлы: каталоги и устройства (/dev/zero) не хэшируются
+    if not os.path.isfile(file_path):
+        return None
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    with _asset_manifest_lock:
+        entry = _asset_manifest.get(manifest_key)
+        if entry and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[2]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BOOK_STREAM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()[:ASSET_HASH_LENGTH]
+    with _asset_manifest_lock:
+        _asset_manifest[manifest_key] = (stat.st_mtime_ns, stat.st_size, fingerprint)
+    return fingerprint
+
+def get_asset_fingerprint(name):
+    file_path = safe_join(app.static_folder, name)
+    if file_path is None:
+        return None
+    return get_file_fingerprint(file_path, name)
+
+# Хэш файла из манифеста, собранного при запуске (пересчитывается, если файл
+# изменился). Других имен нет: по URL из запроса новые файлы не хэшируются
+def get_manifest_fingerprint(name):
+    with _asset_manifest_lock:
+        if name not in _asset_manifest:
+            return None
+    return get_asset_fingerprint(name)
+
+# URL статического файла с хэшем (в шаблонах: {{ asset_url('css/site.css') }})
+def asset_url(name):
+    name = name.lstrip('/')
+    fingerprint = get_manifest_fingerprint(name)
+    if fingerprint is None:
+        return f'/static/{name}'
+    stem, dot, ext = name.rpartition('.')
+    if not dot or '/' in ext:
+        return f'/assets/{name}.{fingerprint}'
+    return f'/assets/{stem}.{fingerprint}.{ext}'
+
+# Хэши всех файлов static при запуске
+def build_asset_manifest():
+    if not app.static_folder or not os.path.isdir(app.static_folder):
+        return
+    # Фоны (загруженные оригиналы и их копии) отдаются через /backgrounds/, их не хэшируем
+    backgrounds_dir = os.path.realpath(BACKGROUNDS_DIR)
+    for root, dirs, filenames in os.walk(app.static_folder):
+        if os.path.realpath(root) == backgrounds_dir:
+            dirs[:] = []
+            continue
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(root, filename), app.static_folder).replace(os.sep, '/')
+            get_asset_fingerprint(name)
+
+app.jinja_env.globals['asset_url'] = asset_url
+build_asset_manifest()
+
+# Готовый ответ GET /api/settings (настройки и список фонов) с ETag.
+# Пересобирается, когда меняются настройки в хранилище, папка фонов
+# или список стандартных фонов в .env
+_settings_payload_lock = threading.Lock()
+_settings_payload = {'stamp': None, 'body': None, 'etag': None}
+
+def get_backgrounds_dir_mtime():
+    try:
+        return os.stat(BACKGROUNDS_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+# URL фона с хэшем содержимого (для файлов из static и BACKGROUNDS_DIR)
+def get_background_url(url):
+    if url and url.startswith('/static/'):
+        # Стандартные фоны, лежащие в BACKGROUNDS_DIR, не входят в манифест static
+        file_path = safe_join(app.static_folder, url[len('/static/'):])
+        if file_path and os.path.dirname(os.path.realpath(file_path)) == os.path.realpath(BACKGROUNDS_DIR):
+            url = '/backgrounds/' + os.path.basename(file_path)
+        else:
+            return asset_url(url[len('/static/'):])
+    if url and url.startswith('/backgrounds/'):
+        filename = url[len('/backgrounds/'):]
+        # Загруженные фоны уже названы по хэшу содержимого
+        if re.fullmatch(r'[0-9a-f]{64}\.\w+', filename):
+            return url
+        fingerprint = get_file_fingerprint(os.path.join(BACKGROUNDS_DIR, filename), 'background:' + filename)
+        if fingerprint:
+            return f'{url}?v={fingerprint}'
+    return url
+
+def build_settings_payload(settings, backgrounds):
+    # Стандартные фоны
+    backgrounds_list = [{
+        'name': bg,
+        'url': get_background_url(f'/static/backgrounds/{bg}')
+    } for bg in backgrounds]
     
-    return jsonify(books)
+    # Пользовательские фоны из папки (кроме уже добавленных)
+    names = set(backgrounds)
+    if os.path.exists(BACKGROUNDS_DIR):
+        for filename in sorted(os.listdir(BACKGROUNDS_DIR)):
+            if allowed_file(filename, ALLOWED_IMAGE_EXTENSIONS) and filename not in names:
+                names.add(filename)
+                backgrounds_list.append({
+                    'name': filename,
+                    'url': get_background_url(f'/backgrounds/{filename}')
+                })
+    
+    # Выбранный фон отдается тем же URL, что и в списке
+    if settings.get('background'):
+        settings = dict(settings, background=get_background_url(settings['background']))
+    return {
+        'settings': settings,
+        'availableBackgrounds': backgrounds_list
+    }
 
-# API: Получить текст книги для чтения
-@app.route('/api/books/<path:book_id>/text')
-def get_book_text(book_id):
+# (тело JSON, ETag)
+def get_settings_payload():
+    backgrounds = get_available_backgrounds()
+    stamp = (storage.settings_version(), get_backgrounds_dir_mtime(), tuple(backgrounds))
+    with _settings_payload_lock:
+        if _settings_payload['body'] is None or _settings_payload['stamp'] != stamp:
+            body = app.json.dumps(build_settings_payload(storage.get_settings(), backgrounds)).encode('utf-8')
+            _settings_payload['body'] = body
+            _settings_payload['etag'] = hashlib.sha256(body).hexdigest()[:32]
+            _settings_payload['stamp'] = stamp
+        return _settings_payload['body'], _settings_payload['etag']
+
+def forget_settings_payload():
+    with _settings_payload_lock:
+        _settings_payload['body'] = None
+
+# Каталог книг в памяти процесса: загружается один раз и перечитывается
+# только при изменении папки книг (mtime) другим процессом
+_catalog_lock = threading.RLock()
+_catalog = {
+    'books': {},        # id книги -> метаданные
+    'files': {},        # id книги -> имя файла с текстом в BOOKS_DIR
+    'loaded': False,    # каталог уже загружен с диска
+    'stamp': None,      # состояние хранилища на момент загрузки (см. get_catalog_stamp)
+    'covers_job': None, # задача переноса встроенных обложек (ставится один раз на процесс)
+    'version': 0        # счетчик изменений каталога
+}
+
+# mtime папки книг (меняется при создании/удалении/переименовании файлов)
+def get_books_dir_mtime():
     try:
-        from urllib.parse import unquote
-        book_id = unquote(book_id)
-        # Убираем лишние кавычки, если они есть
-        book_id = book_id.strip('"').strip("'").strip()
-        
-        print(f"Запрос текста книги для ID: {book_id}")
-        print(f"BOOKS_DIR: {BOOKS_DIR}")
-        
-        # Проверяем существование папки
-        if not os.path.exists(BOOKS_DIR):
-            print(f"Папка {BOOKS_DIR} не существует")
-            return jsonify({'error': f'Папка книг не найдена: {BOOKS_DIR}'}), 404
-        
-        # Ищем файл метаданных
-        meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
-        print(f"Проверка метаданных: {meta_path}, существует: {os.path.exists(meta_path)}")
-        
-        if os.path.exists(meta_path):
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                book_data = json.load(f)
-                book_file = book_data.get('book_file')
-                print(f"Найдены метаданные, book_file: {book_file}")
-                
-                if book_file:
-                    file_path = os.path.join(BOOKS_DIR, book_file)
-                    print(f"Путь к файлу: {file_path}, существует: {os.path.exists(file_path)}")
-                    if os.path.exists(file_path):
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            text = f.read()
-                        print(f"Файл прочитан, размер текста: {len(text)} символов")
-                        return jsonify({
-                            'text': text,
-                            'title': book_data.get('title', 'Книга'),
-                            'author': book_data.get('author', 'Неизвестен')
-                        })
-        
-        # Также проверяем файл напрямую (book_id может быть именем файла)
-        book_file_path = os.path.join(BOOKS_DIR, book_id)
-        print(f"Проверка прямого пути: {book_file_path}, существует: {os.path.exists(book_file_path)}")
-        
-        if os.path.exists(book_file_path) and not book_file_path.endswith('.json'):
-            with open(book_file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-            print(f"Файл прочитан напрямую, размер: {len(text)} символов")
-            return jsonify({
-                'text': text,
-                'title': book_id.replace('.txt', '').replace('.TXT', ''),
-                'author': 'Неизвестен'
-            })
-        
-        # Ищем по всем файлам в папке
-        print(f"Поиск по всем файлам в {BOOKS_DIR}")
-        files_in_dir = os.listdir(BOOKS_DIR) if os.path.exists(BOOKS_DIR) else []
-        print(f"Файлы в папке: {files_in_dir}")
-        
-        for filename in files_in_dir:
-            if filename.endswith('.json'):
-                file_path = os.path.join(BOOKS_DIR, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        book_data = json.load(f)
-                    print(f"Проверка файла {filename}, ID в данных: {book_data.get('id')}")
-                    if book_data.get('id') == book_id:
-                        book_file = book_data.get('book_file')
-                        if book_file:
-                            book_file_path = os.path.join(BOOKS_DIR, book_file)
-                            if os.path.exists(book_file_path):
-                                with open(book_file_path, 'r', encoding='utf-8') as f:
-                                    text = f.read()
-                                print(f"Найдена книга по ID, размер текста: {len(text)}")
-                                return jsonify({
-                                    'text': text,
-                                    'title': book_data.get('title', 'Книга'),
-                                    'author': book_data.get('author', 'Неизвестен')
-                                })
-                except Exception as e:
-                    print(f"Ошибка при чтении {filename}: {e}")
-                    continue
-        
-        error_msg = f'Файл книги не найден. ID: {book_id}, Папка: {BOOKS_DIR}'
-        print(error_msg)
-        return jsonify({'error': error_msg}), 404
+        return os.stat(BOOKS_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+# Состояние, по которому видно, что каталог изменил другой процесс:
+# mtime папки книг и счетчик изменений хранилища
+def get_catalog_stamp():
+    return get_books_dir_mtime(), storage.books_version()
+
+# Полная загрузка каталога: (метаданные книг, файлы книг)
+def load_catalog():
+    books = storage.load_books()
+    files = {}
+    if os.path.exists(BOOKS_DIR):
+        filenames = os.listdir(BOOKS_DIR)
+        existing = set(filenames)
+        for book_id, book in books.items():
+            if book.get('book_file') in existing:
+                files[book_id] = book['book_file']
+        # Файлы книг без метаданных доступны по имени файла
+        for filename in filenames:
+            if allowed_file(filename, ALLOWED_BOOK_EXTENSIONS):
+                files.setdefault(filename, filename)
+    return books, files
+
+# Получить каталог (перечитывается, только если папка изменилась)
+def get_catalog():
+    stamp = get_catalog_stamp()
+    migrate_covers = False
+    with _catalog_lock:
+        if not _catalog['loaded'] or _catalog['stamp'] != stamp:
+            _catalog['books'], _catalog['files'] = load_catalog()
+            _catalog['loaded'] = True
+            search_index_rebuild(_catalog['books'].values())
+            _catalog['stamp'] = stamp
+            _catalog['version'] += 1
+            # Книги со встроенными обложками отдаются как есть, а перенос идет в фоне
+            if _catalog['covers_job'] is None and any(has_legacy_cover(book) for book in _catalog['books'].values()):
+                _catalog['covers_job'] = True
+                migrate_covers = True
+        books = _catalog['books']
+    if migrate_covers:
+        _catalog['covers_job'] = submit_job('migrate_covers')['id']
+    return books
+
+# Добавить/обновить книгу в каталоге после записи метаданных.
+# stamp_before - get_catalog_stamp(), взятый перед записью: если кэш ему
+# соответствует, других изменений не было и новое состояние можно принять;
+# иначе другой процесс успел что-то изменить и каталог перечитывается
+def catalog_put(book, stamp_before):
+    catalog_put_many([book], stamp_before)
+
+# Добавить/обновить несколько книг за одно обновление каталога
+def catalog_put_many(new_books, stamp_before):
+    with _catalog_lock:
+        if _catalog['loaded'] and _catalog['stamp'] != stamp_before:
+            _catalog['loaded'] = False
+        if _catalog['loaded']:
+            # Копия при записи: читатели могут итерировать старый словарь
+            books = dict(_catalog['books'])
+            files = dict(_catalog['files'])
+            for book in new_books:
+                books[book['id']] = book
+                if book.get('book_file'):
+                    files[book['id']] = book['book_file']
+                else:
+                    files.pop(book['id'], None)
+                search_index_add(book)
+            _catalog['books'] = books
+            _catalog['files'] = files
+            _catalog['stamp'] = get_catalog_stamp()
+        _catalog['version'] += 1
+
+# Удалить книгу из каталога после удаления файлов (stamp_before - как в catalog_put)
+def catalog_remove(book_id, stamp_before):
+    with _catalog_lock:
+        if _catalog['loaded'] and _catalog['stamp'] != stamp_before:
+            _catalog['loaded'] = False
+        if _catalog['loaded']:
+            books = dict(_catalog['books'])
+            books.pop(book_id, None)
+            files = dict(_catalog['files'])
+            files.pop(book_id, None)
+            _catalog['books'] = books
+            _catalog['files'] = files
+            search_index_remove(book_id)
+            _catalog['stamp'] = get_catalog_stamp()
+        _catalog['version'] += 1
+
+# Найти книгу по ID без обхода папки: (метаданные или None, имя файла или None)
+def resolve_book(book_id):
+    with _catalog_lock:
+        books = get_catalog()
+        return books.get(book_id), _catalog['files'].get(book_id)
+
+# Нормализация ID книги из URL (может быть URL-encoded и в кавычках)
+def clean_book_id(book_id):
+    from urllib.parse import unquote
+    return unquote(book_id).strip('"').strip("'").strip()
+
+# Название и автор для ответа (у файлов без метаданных — по имени файла)
+def book_display_info(book_data, book_id):
+    if book_data:
+        return book_data.get('title', 'Книга'), book_data.get('author', 'Неизвестен')
+    return book_id.replace('.txt', '').replace('.TXT', ''), 'Неизвестен'
+
+# Поисковый индекс по каталогу: токен -> множество id книг.
+# Обновляется вместе с каталогом (под той же блокировкой)
+SEARCH_FIELDS = ('title', 'author', 'genre', 'description')
+
+_search_index = {
+    'postings': {},     # токен -> set(id книг)
+    'tokens': [],       # отсортированный список токенов (для поиска по префиксу)
+    'book_tokens': {}   # id книги -> set(токенов) (для удаления)
+}
+
+# Приведение к нижнему регистру с учетом кириллицы (ё == е)
+def normalize_search_text(text):
+    return str(text or '').casefold().replace('ё', 'е')
+
+# Разбиение текста на токены
+def tokenize(text):
+    return re.findall(r'\w+', normalize_search_text(text))
+
+def search_index_add(book):
+    book_id = book.get('id')
+    search_index_remove(book_id)
+    tokens = set()
+    for field in SEARCH_FIELDS:
+        tokens.update(tokenize(book.get(field, '')))
+    postings = _search_index['postings']
+    for token in tokens:
+        if token not in postings:
+            postings[token] = set()
+            bisect.insort(_search_index['tokens'], token)
+        postings[token].add(book_id)
+    _search_index['book_tokens'][book_id] = tokens
+
+def search_index_remove(book_id):
+    tokens = _search_index['book_tokens'].pop(book_id, set())
+    postings = _search_index['postings']
+    for token in tokens:
+        ids = postings.get(token)
+        if ids is None:
+            continue
+        ids.discard(book_id)
+        if not ids:
+            del postings[token]
+            pos = bisect.bisect_left(_search_index['tokens'], token)
+            del _search_index['tokens'][pos]
+
+def search_index_rebuild(books):
+    _search_index['postings'] = {}
+    _search_index['tokens'] = []
+    _search_index['book_tokens'] = {}
+    for book in books:
+        search_index_add(book)
+
+# id книг, у которых есть токен, начинающийся с prefix
+def search_prefix(prefix):
+    tokens = _search_index['tokens']
+    postings = _search_index['postings']
+    found = set()
+    pos = bisect.bisect_left(tokens, prefix)
+    while pos < len(tokens) and tokens[pos].startswith(prefix):
+        found |= postings[tokens[pos]]
+        pos += 1
+    return found
+
+# Поиск книг: каждое слово запроса должно быть началом слова
+# в названии, авторе, жанре или описании
+def search_books(query):
+    catalog = get_catalog()
+    query_tokens = tokenize(query)
+    if not query_tokens:
+        return []
+    with _catalog_lock:
+        # Начинаем с самого редкого слова, чтобы пересечения были короче
+        matches = sorted((search_prefix(token) for token in set(query_tokens)), key=len)
+        ids = set.intersection(*matches)
+    books = [catalog[book_id] for book_id in ids if book_id in catalog]
+    return sort_books(books, 'title')
+
+# Сортировка каталога: title, author, added_at (с "-" — по убыванию)
+BOOK_SORT_KEYS = {
+    'title': lambda book: normalize_search_text(book.get('title')),
+    'author': lambda book: normalize_search_text(book.get('author')),
+    'added_at': lambda book: book_added_at(book)
+}
+
+# Отсортированные списки каталога: sort -> (версия каталога, список книг)
+_sorted_catalog = {}
+
+def book_added_at(book):
+    try:
+        return float(book.get('added_at') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def sort_books(books, sort):
+    key = BOOK_SORT_KEYS[sort.lstrip('-')]
+    return sorted(books, key=key, reverse=sort.startswith('-'))
+
+# Отсортированный каталог (пересчитывается только после изменения каталога)
+def get_sorted_catalog(sort):
+    with _catalog_lock:
+        catalog = get_catalog()
+        cached = _sorted_catalog.get(sort)
+        if cached is None or cached[0] != _catalog['version']:
+            cached = (_catalog['version'], sort_books(catalog.values(), sort))
+            _sorted_catalog[sort] = cached
+        return cached[1]
+
+# Оставить у книги только запрошенные поля (id есть всегда)
+def project_book(book, fields):
+    if not fields:
+        return book
+    return {field: book[field] for field in fields if field in book}
+
+# Сохранение метаданных книги
+def save_book_meta(book):
+    storage.save_book(book)
+
+# Разбор data URI обложки: (mime, байты) или None, если это не data URI
+def parse_cover_data_uri(cover):
+    match = re.match(r'^data:([\w/+.-]+);base64,(.*)$', cover or '', re.DOTALL)
+    if not match:
+        return None
+    mime = match.group(1).lower()
+    if mime not in COVER_MIME_EXTENSIONS:
+        raise ValueError(f'Неподдерживаемый формат обложки: {mime}')
+    try:
+        data = base64.b64decode(match.group(2), validate=False)
+    except ValueError:
+        raise ValueError('Обложка повреждена (некорректный base64)')
+    if not data:
+        raise ValueError('Обложка пустая')
+    return mime, data
+
+# Миниатюры обложки: имя -> имя файла (пропускаются без Pillow и для SVG)
+def create_cover_thumbnails(data, cover_hash, ext):
+    thumbs = {}
+    if Image is None or ext == 'svg':
+        return thumbs
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img_format = img.format
+            for size_name, width in COVER_THUMB_SIZES.items():
+                thumb_name = f'{cover_hash}_{size_name}.{ext}'
+                thumb_path = os.path.join(COVERS_DIR, thumb_name)
+                if not os.path.exists(thumb_path):
+                    thumb = img.copy()
+                    thumb.thumbnail((width, width * 2))
+                    if img_format == 'JPEG' and thumb.mode not in ('RGB', 'L'):
+                        thumb = thumb.convert('RGB')
+                    buffer = io.BytesIO()
+                    thumb.save(buffer, format=img_format)
+                    write_bytes_atomic(thumb_path, buffer.getvalue())
+                thumbs[size_name] = thumb_name
     except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Исключение в get_book_text: {error_trace}")
-        return jsonify({'error': f'Ошибка: {str(e)}', 'traceback': error_trace}), 500
-
-# API: Страница чтения книги
-@app.route('/read')
-def read_book():
-    return render_template('reader.html')
-
-# API: Скачать файл книги
-@app.route('/api/books/<path:book_id>/download')
-def download_book(book_id):
+        print(f'Ошибка создания миниатюр обложки {cover_hash}: {e}')
+    return thumbs
+
+# Сохранить обложку из data URI в хранилище (имя файла = sha256 содержимого).
+# Возвращает (url обложки, {размер: url миниатюры}); обычные URL не меняются
+def store_cover(cover):
+    parsed = parse_cover_data_uri(cover)
+    if parsed is None:
+        return cover, {}
+    mime, data = parsed
+    ext = COVER_MIME_EXTENSIONS[mime]
+    cover_hash = hashlib.sha256(data).hexdigest()
+    filename = f'{cover_hash}.{ext}'
+    file_path = os.path.join(COVERS_DIR, filename)
+    if not os.path.exists(file_path):
+        write_bytes_atomic(file_path, data)
+    thumbs = create_cover_thumbnails(data, cover_hash, ext)
+    return f'/covers/{filename}', {name: f'/covers/{thumb}' for name, thumb in thumbs.items()}
+
+# Книга добавлена до появления хранилища обложек, и ее обложку еще не пробовали перенести
+def has_legacy_cover(book):
+    return str(book.get('cover', '')).startswith('data:') and not book.get('cover_error')
+
+# Перенос встроенной обложки из старых метаданных в хранилище обложек.
+# Обложка, которую не удалось разобрать, помечается cover_error и больше не переносится
+def extract_book_cover(book):
     try:
-        # Ищем файл метаданных (book_id уже содержит формат, например "название.txt")
-        # Декодируем book_id (он может быть URL-encoded)
-        from urllib.parse import unquote
-        book_id = unquote(book_id)
-        # Убираем лишние кавычки, если они есть
-        book_id = book_id.strip('"').strip("'").strip()
-        
-        meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
-        
-        if os.path.exists(meta_path):
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                book_data = json.load(f)
-                book_file = book_data.get('book_file')
-                
-                if book_file:
-                    file_path = os.path.join(BOOKS_DIR, book_file)
-                    if os.path.exists(file_path):
-                        # Открываем файл в браузере, а не скачиваем
-                        response = send_from_directory(BOOKS_DIR, book_file, as_attachment=False)
-                        # Устанавливаем правильный Content-Type для текстовых файлов
-                        if book_file.endswith('.txt'):
-                            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-                        return response
-                    else:
-                        # Если файл не найден по имени из метаданных, пробуем найти по ID
-                        # (возможно, файл был сохранен с другим именем)
-                        pass
-        
-        # Также проверяем, может быть файл сам по себе (book_id = название.txt)
-        book_file_path = os.path.join(BOOKS_DIR, book_id)
-        if os.path.exists(book_file_path) and not book_file_path.endswith('.json'):
-            # Открываем файл в браузере, а не скачиваем
-            response = send_from_directory(BOOKS_DIR, book_id, as_attachment=False)
-            if book_id.endswith('.txt'):
-                response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-            return response
-        
-        # Пробуем найти все файлы в папке books и найти подходящий
-        if os.path.exists(BOOKS_DIR):
-            # Ищем метаданные по всем файлам
-            for filename in os.listdir(BOOKS_DIR):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(BOOKS_DIR, filename)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            book_data = json.load(f)
-                            if book_data.get('id') == book_id:
-                                book_file = book_data.get('book_file')
-                                if book_file:
-                                    book_file_path = os.path.join(BOOKS_DIR, book_file)
-                                    if os.path.exists(book_file_path):
-                                        # Открываем файл в браузере, а не скачиваем
-                                        response = send_from_directory(BOOKS_DIR, book_file, as_attachment=False)
-                                        if book_file.endswith('.txt'):
-                                            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-                                        return response
-                    except Exception:
-                        continue
-        
-        return jsonify({'error': 'Файл книги не найден'}), 404
+        cover_url, thumbs = store_cover(book.get('cover'))
+    except ValueError as e:
+        print(f'Обложка книги {book.get("id")} не перенесена: {e}')
+        book['cover_error'] = str(e)
+    else:
+        if cover_url == book.get('cover'):
+            return book
+        book['cover'] = cover_url
+        book['cover_thumbs'] = thumbs
+    try:
+        save_book_meta(book)
     except Exception as e:
-        import traceback
-        return jsonify({'error': f'Ошибка: {str(e)}', 'traceback': traceback.format_exc()}), 500
+        print(f'Ошибка сохранения метаданных книги {book.get("id")}: {e}')
+    return book
+
+# Фоновая задача: перенести все встроенные обложки (ставится каталогом, когда он их находит)
+def run_cover_migration_job(job):
+    job['status'] = 'running'
+    catalog_stamp = get_catalog_stamp()
+    books = [extract_book_cover(dict(book, id=book_id))
+             for book_id, book in storage.load_books().items() if has_legacy_cover(book)]
+    if books:
+        catalog_put_many(books, catalog_stamp)
+    job['result'] = {
+        'migrated': sum(1 for book in books if not book.get('cover_error')),
+        'failed': sum(1 for book in books if book.get('cover_error'))
+    }
 
-# Функция для создания безопасного имени файла из названия
-def create_book_filename(title, file_format='txt'):
-    # Убираем спецсимволы, оставляем только буквы, цифры, пробелы и дефисы
-    filename = re.sub(r'[^\w\s-]', '', title)
-    # Заменяем пробелы на подчеркивания
-    filename = re.sub(r'\s+', '_', filename)
-    # Убираем множественные подчеркивания
-    filename = re.sub(r'_+', '_', filename)
-    # Убираем подчеркивания в начале и конце
-    filename = filename.strip('_')
-    # Если пустое, используем "book"
-    if not filename:
-        filename = "book"
-    # Добавляем формат
-    return f"{filename}.{file_format}"
+# Загруженные фоны хранятся как BACKGROUNDS_DIR/<sha256>.<расширение> (оригинал),
+# а фоновая задача делает из них копии нужной ширины в WebP и JPEG:
+# BACKGROUND_VARIANTS_DIR/<sha256>_<ширина>.<формат> и список копий <sha256>.json
+_background_manifests = {}
+
+def store_background(data, ext):
+    background_hash = hashlib.sha256(data).hexdigest()
+    filename = f'{background_hash}.{ext}'
+    file_path = os.path.join(BACKGROUNDS_DIR, filename)
+    if not os.path.exists(file_path):
+        fd, temp_path = tempfile.mkstemp(dir=BACKGROUNDS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+    return filename
+
+def get_background_manifest_path(background_hash):
+    return os.path.join(BACKGROUND_VARIANTS_DIR, background_hash + '.json')
+
+# Список копий фона или None, если копии еще не готовы
+def read_background_manifest(background_hash):
+    manifest = _background_manifests.get(background_hash)
+    if manifest is None:
+        try:
+            with open(get_background_manifest_path(background_hash), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        _background_manifests[background_hash] = manifest
+    return manifest
+
+# Сделать копии фона. SVG и GIF (анимация) не перекодируются: список копий пуст
+def build_background_variants(filename):
+    background_hash, ext = filename.rsplit('.', 1)
+    variants = []
+    if Image is not None and ext.lower() not in ('svg', 'gif'):
+        with Image.open(os.path.join(BACKGROUNDS_DIR, filename)) as img:
+            img = ImageOps.exif_transpose(img)
+            widths = [width for width in BACKGROUND_WIDTHS if width < img.width]
+            widths.append(min(img.width, BACKGROUND_WIDTHS[-1]))
+            for width in sorted(set(widths)):
+                height = max(1, round(img.height * width / img.width))
+                resized = img.resize((width, height), Image.LANCZOS) if width != img.width else img
+                for fmt, pil_format in (('webp', 'WEBP'), ('jpg', 'JPEG')):
+                    variant_name = f'{background_hash}_{width}.{fmt}'
+                    variant = resized
+                    if fmt == 'jpg' and variant.mode != 'RGB':
+                        variant = variant.convert('RGB')
+                    elif fmt == 'webp' and variant.mode not in ('RGB', 'RGBA'):
+                        variant = variant.convert('RGBA' if 'A' in variant.getbands() else 'RGB')
+                    variant.save(os.path.join(BACKGROUND_VARIANTS_DIR, variant_name), format=pil_format,
+                                 quality=BACKGROUND_QUALITY[fmt], optimize=True)
+                    variants.append({'width': width, 'format': fmt, 'file': variant_name})
+    manifest = {'original': filename, 'variants': variants}
+    write_json_atomic(get_background_manifest_path(background_hash), manifest)
+    _background_manifests[background_hash] = manifest
+    return manifest
+
+# Копия под клиента: WebP, если браузер его принимает, и самая узкая из тех,
+# что не уже нужной ширины (иначе самая широкая). None - отдавать оригинал
+def pick_background_variant(manifest, accept_webp, width):
+    formats = ('webp', 'jpg') if accept_webp else ('jpg',)
+    for fmt in formats:
+        candidates = sorted((v for v in manifest['variants'] if v['format'] == fmt), key=lambda v: v['width'])
+        if candidates:
+            return next((v for v in candidates if v['width'] >= width), candidates[-1])
+    return None
+
+# Нужная ширина фона: ?w=, иначе Client Hints (ширина окна * DPR), иначе по умолчанию
+def get_requested_background_width():
+    try:
+        width = request.args.get('w', type=int)
+        if width is None:
+            viewport = request.headers.get('Sec-CH-Viewport-Width') or request.headers.get('Viewport-Width')
+            dpr = request.headers.get('Sec-CH-DPR') or request.headers.get('DPR') or 1
+            width = round(float(viewport) * float(dpr)) if viewport else BACKGROUND_DEFAULT_WIDTH
+    except ValueError:
+        width = BACKGROUND_DEFAULT_WIDTH
+    return max(1, width)
+
+def run_background_job(job):
+    job['status'] = 'running'
+    job['progress'] = {'step': 'variants', 'done': 0, 'total': 1}
+    save_job(job)
+    manifest = build_background_variants(job['filename'])
+    job['progress'] = {'step': None, 'done': 1, 'total': 1}
+    job['result'] = {'variants': len(manifest['variants'])}
+
+# Индексы текста книги хранятся в BOOK_INDEX_DIR/<id книги>/<вид>.json
+# и содержат размер и mtime файла книги, по которым проверяется актуальность
+def get_book_index_path(book_id, kind):
+    return os.path.join(BOOK_INDEX_DIR, book_id, kind + '.json')
+
+def book_file_signature(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_book_index(book_id, kind, file_path):
+    try:
+        with open(get_book_index_path(book_id, kind), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('source') != book_file_signature(file_path):
+        return None
+    return index
+
+def save_book_index(book_id, kind, file_path, index):
+    index['source'] = book_file_signature(file_path)
+    index_path = get_book_index_path(book_id, kind)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    # Запись через временный файл: фоновая задача и запрос могут строить индекс одновременно
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(temp_path, index_path)
+    return index
+
+def remove_book_indexes(book_id):
+    shutil.rmtree(os.path.join(BOOK_INDEX_DIR, book_id), ignore_errors=True)
+
+# Абзацы книги: пары [начало, конец) в байтах. Абзацы разделяются пустыми
+# строками — так же, как в splitIntoPages() в reader.html
+def build_paragraph_offsets(file_path):
+    paragraphs = []
+    start = None
+    end = 0
+    offset = 0
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                if start is None:
+                    start = offset
+                end = offset + len(line.rstrip(b'\r\n'))
+            elif start is not None:
+                paragraphs.append([start, end])
+                start = None
+            offset += len(line)
+    if start is not None:
+        paragraphs.append([start, end])
+    return paragraphs
+
+# Кэш индексов в памяти: (id книги, вид индекса) -> индекс
+_book_indexes = {}
+
+# Индекс книги (из памяти, с диска или строится заново через build, если устарел).
+# params — параметры построения; индекс с другими params тоже считается устаревшим
+def get_book_index(book_id, book_file, kind, build, params=None):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    index = _book_indexes.get((book_id, kind))
+    if (index is None or index['source'] != book_file_signature(file_path)
+            or index.get('params') != params):
+        index = read_book_index(book_id, kind, file_path)
+        if index is None or index.get('params') != params:
+            index = build()
+            index['params'] = params
+            index = save_book_index(book_id, kind, file_path, index)
+        _book_indexes[(book_id, kind)] = index
+    return index
+
+def forget_book_indexes(book_id):
+    for key in [key for key in list(_book_indexes) if key[0] == book_id]:
+        _book_indexes.pop(key, None)
+    remove_book_indexes(book_id)
+
+def get_paragraph_index(book_id, book_file):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    index = get_book_index(book_id, book_file, 'paragraphs', lambda: {
+        'paragraphs': build_paragraph_offsets(file_path)
+    })
+    return index['paragraphs']
 
-# API: Вход админа
-@app.route('/api/admin/login', methods=['POST'])
-def admin_login():
-    data = request.json
-    username = data.get('username', '').strip()
-    password = data.get('password', '').strip()
-    
-    # Получаем данные из .env или используем значения по умолчанию
-    admin_username = os.getenv('ADMIN_USERNAME', 'admin').strip()
-    admin_password = os.getenv('ADMIN_PASSWORD', 'admin123').strip()
-    
-    # Простая проверка - используем значения по умолчанию если не заданы в .env
-    if not admin_username or admin_username == '':
-        admin_username = 'admin'
-    if not admin_password or admin_password == '':
-        admin_password = 'admin123'
-    
-    if username == admin_username and password == admin_password:
-        session['username'] = username
-        session['is_admin'] = True
-        session.permanent = True
-        return jsonify({'message': 'Вход выполнен успешно', 'is_admin': True})
+# Большие книги открываются через mmap: страницы файла берутся из общего
+# кэша ОС (одного на все процессы), а срезы делаются без копирования.
+# Возвращает mmap или обычный файл (для маленьких и пустых файлов)
+def open_book_source(file_path):
+    f = open(file_path, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size < BOOK_MMAP_MIN_SIZE:
+            return f
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return f
+    f.close()
+    return mapped
+
+# Блоки содержимого: у mmap — срезы memoryview (освобождаются после yield)
+def iter_source_chunks(source, chunk_size=BOOK_STREAM_CHUNK_SIZE):
+    if isinstance(source, mmap.mmap):
+        view = memoryview(source)
+        try:
+            for start in range(0, len(view), chunk_size):
+                with view[start:start + chunk_size] as chunk:
+                    yield chunk
+        finally:
+            view.release()
     else:
-        return jsonify({'error': f'Неверный логин или пароль. Попробуйте: {admin_username} / {admin_password}'}), 401
-
-# API: Выход
-@app.route('/api/logout', methods=['POST'])
-def logout():
-    session.clear()
-    return jsonify({'message': 'Выход выполнен'})
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
 
-# API: Проверка авторизации
-@app.route('/api/check-auth', methods=['GET'])
-def check_auth():
-    return jsonify({
-        'is_admin': session.get('is_admin', False),
-        'username': session.get('username')
-    })
+# Прочитать абзацы [offset, offset + limit) — только нужный участок файла
+def read_paragraphs(book_file, paragraphs, offset, limit):
+    window = paragraphs[offset:offset + limit]
+    if not window:
+        return []
+    base = window[0][0]
+    source = open_book_source(os.path.join(BOOKS_DIR, book_file))
+    try:
+        if isinstance(source, mmap.mmap):
+            data = memoryview(source)
+            base = 0
+        else:
+            source.seek(base)
+            data = source.read(window[-1][1] - base)
+        texts = []
+        for start, end in window:
+            with memoryview(data)[start - base:end - base] as part:
+                texts.append(' '.join(str(part, 'utf-8', 'replace').split()))
+        if isinstance(data, memoryview):
+            data.release()
+        return texts
+    finally:
+        source.close()
+
+# Разбиение книги на страницы по правилам splitIntoPages() из reader.html.
+# Страница — [первый абзац, последний + 1] или, для слишком длинного абзаца,
+# [абзац, абзац + 1, первое слово, последнее слово + 1, начало, конец в байтах]
+def build_page_boundaries(book_file, paragraphs, words_per_page=BOOK_WORDS_PER_PAGE):
+    pages = []
+    page_start = None
+    word_count = 0
+    with open(os.path.join(BOOKS_DIR, book_file), 'rb') as f:
+        for i, (start, end) in enumerate(paragraphs):
+            f.seek(start)
+            # surrogateescape: длины в байтах совпадают с файлом и для некорректного UTF-8
+            text = f.read(end - start).decode('utf-8', errors='surrogateescape')
+            words = len(text.split())
+            # Абзац помещается на текущую страницу
+            if page_start is not None and word_count + words <= words_per_page:
+                word_count += words
+                continue
+            # Сохраняем текущую страницу и начинаем новую
+            if page_start is not None:
+                pages.append([page_start, i])
+            page_start = i
+            word_count = words
+            # Слишком длинный абзац разбиваем на несколько страниц
+            if word_count > words_per_page:
+                for n, (byte_start, byte_end) in enumerate(split_paragraph_words(text, start, words_per_page)):
+                    word_start = n * words_per_page
+                    pages.append([i, i + 1, word_start, min(word_start + words_per_page, words), byte_start, byte_end])
+                page_start = None
+                word_count = 0
+    if page_start is not None:
+        pages.append([page_start, len(paragraphs)])
+    return pages
+
+# Байтовые границы страниц длинного абзаца: [начало первого слова, конец последнего)
+# для каждых words_per_page слов. text — абзац, декодированный с surrogateescape,
+# start — его начало в файле
+def split_paragraph_words(text, start, words_per_page):
+    ranges = []
+    position = [0, start]  # (символ, байт) — последнее пересчитанное место
+
+    def byte_offset(char_offset):
+        position[1] += len(text[position[0]:char_offset].encode('utf-8', errors='surrogateescape'))
+        position[0] = char_offset
+        return position[1]
+
+    page_begin = None
+    word_end = 0
+    for n, match in enumerate(re.finditer(r'\S+', text)):
+        if n % words_per_page == 0:
+            if page_begin is not None:
+                ranges.append((page_begin, byte_offset(word_end)))
+            page_begin = byte_offset(match.start())
+        word_end = match.end()
+    if page_begin is not None:
+        ranges.append((page_begin, byte_offset(word_end)))
+    return ranges
+
+def get_page_index(book_id, book_file):
+    paragraphs = get_paragraph_index(book_id, book_file)
+    index = get_book_index(book_id, book_file, 'pages', lambda: {
+        'pages': build_page_boundaries(book_file, paragraphs)
+    }, params={'words_per_page': BOOK_WORDS_PER_PAGE, 'byte_ranges': True})
+    return paragraphs, index['pages']
+
+# Оглавление: заголовки частей и глав среди коротких абзацев.
+# Уровень 1 — часть/том/книга, уровень 2 — глава или строка из римской цифры.
+# После ключевого слова обязателен номер: цифры, римская цифра или порядковое
+# слово, иначе "Том молчал." или "Глава семьи вышел" считались бы заголовками
+TOC_ROMAN_NUMERAL = r'(?-i:(?=[IVXLCDM])M{0,3}(?:CM|CD|D?C{0,3})(?:XC|XL|L?X{0,3})(?:IX|IV|V?I{0,3}))'
+TOC_ORDINAL_WORDS = (
+    r'(?:перв|втор|трет|четв[её]рт|пят|шест|седьм|восьм|девят|десят|'
+    r'одиннадцат|двенадцат|тринадцат|четырнадцат|пятнадцат|двадцат|последн)(?:ая|ой|ый|ий|ья|ье|ое|ее|яя)'
+    r'|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth|eleventh|twelfth|last'
+    r'|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve'
+)
+TOC_NUMBER = rf'(?:\d+(?:-[а-яё]{{1,2}})?|{TOC_ROMAN_NUMERAL}|{TOC_ORDINAL_WORDS})(?![\w-])'
+# После номера — необязательное название главы: "Глава 3. Бал", "Chapter IV: The Storm"
+TOC_HEADING_TITLE = r'(?:\s*[.:—–-]?(?:\s+\S+){0,6})?\.?$'
+TOC_LONE_NUMERAL = re.compile(rf'^{TOC_ROMAN_NUMERAL}\.?$')
+TOC_HEADING_PATTERNS = [
+    (1, re.compile(rf'^(часть|том|книга|part|volume|book)\s+{TOC_NUMBER}{TOC_HEADING_TITLE}', re.IGNORECASE)),
+    (1, re.compile(r'^(пролог|эпилог|prologue|epilogue)(\s+\S+){0,3}\.?$', re.IGNORECASE)),
+    (2, re.compile(rf'^(глава|chapter)\s+{TOC_NUMBER}{TOC_HEADING_TITLE}', re.IGNORECASE)),
+    (2, TOC_LONE_NUMERAL)
+]
+TOC_MAX_HEADING_LENGTH = 80
+TOC_ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
+# Однобуквенная римская цифра ("I", "V") может быть и репликой, поэтому она
+# остается заголовком, только если рядом с ней больше одной пустой строки
+# или соседняя такая же глава идет по порядку ("I", затем "II")
+TOC_SPACED_MIN_NEWLINES = 3
+
+def detect_heading(text):
+    first_line = ' '.join(text.strip().split('\n', 1)[0].split())
+    if not first_line or len(first_line) > TOC_MAX_HEADING_LENGTH:
+        return None
+    for level, pattern in TOC_HEADING_PATTERNS:
+        if pattern.match(first_line):
+            return level, first_line
+    return None
+
+def roman_to_int(numeral):
+    total = 0
+    for i, digit in enumerate(numeral):
+        value = TOC_ROMAN_VALUES[digit]
+        if i + 1 < len(numeral) and TOC_ROMAN_VALUES[numeral[i + 1]] > value:
+            total -= value
+        else:
+            total += value
+    return total
 
-# API: Добавить книгу (только для админа)
-@app.route('/api/books', methods=['POST'])
-def add_book():
-    # Проверяем авторизацию
-    if not session.get('is_admin'):
-        return jsonify({'error': 'Требуется авторизация администратора'}), 403
-    
-    # Проверяем тип запроса - FormData или JSON
-    if request.is_json:
-        # Обработка JSON запроса (для совместимости)
-        data = request.json
-        title = data.get('title', '').strip()
-        author = data.get('author', '').strip()
-        genre = data.get('genre', '').strip()
-        description = data.get('description', '')
-        cover = data.get('cover', 'https://via.placeholder.com/150')
-        book_file = None
-    else:
-        # Обработка FormData
-        title = request.form.get('title', '').strip()
-        author = request.form.get('author', '').strip()
-        genre = request.form.get('genre', '').strip()
-        description = request.form.get('description', '')
-        cover = request.form.get('cover', 'https://via.placeholder.com/150')
-        
-        # Проверяем наличие файла
-        if 'book_file' in request.files:
-            book_file = request.files['book_file']
-            if book_file and book_file.filename:
-                book_file = book_file
-            else:
-                book_file = None
+# Есть ли перед абзацем i или после него больше одной пустой строки (начало и конец файла тоже считаются)
+def is_spaced_paragraph(source, paragraphs, i):
+    if i == 0 or i + 1 == len(paragraphs):
+        return True
+    for gap_start, gap_end in ((paragraphs[i - 1][1], paragraphs[i][0]), (paragraphs[i][1], paragraphs[i + 1][0])):
+        source.seek(gap_start)
+        if source.read(min(gap_end - gap_start, 64)).count(b'\n') >= TOC_SPACED_MIN_NEWLINES:
+            return True
+    return False
+
+# Убрать однобуквенные цифры (номера в unconfirmed), у которых нет соседа по порядку
+def drop_unconfirmed_numerals(chapters, unconfirmed):
+    numerals = [(n, roman_to_int(chapter['title'].rstrip('.')))
+                for n, chapter in enumerate(chapters) if TOC_LONE_NUMERAL.match(chapter['title'])]
+    confirmed = set()
+    for (n, value), (next_n, next_value) in zip(numerals, numerals[1:]):
+        if next_value == value + 1:
+            confirmed.update((n, next_n))
+    return [chapter for n, chapter in enumerate(chapters) if n not in unconfirmed or n in confirmed]
+
+def build_toc(book_file, paragraphs, pages):
+    page_starts = [page[0] for page in pages]
+    chapters = []
+    unconfirmed = set()
+    source = open_book_source(os.path.join(BOOKS_DIR, book_file))
+    try:
+        for i, (start, end) in enumerate(paragraphs):
+            # Заголовок — короткий абзац, длинные не читаем целиком
+            source.seek(start)
+            text = source.read(min(end - start, TOC_MAX_HEADING_LENGTH * 4 + 1))
+            heading = detect_heading(text.decode('utf-8', errors='replace'))
+            if heading is None:
+                continue
+            level, title = heading
+            if len(title.rstrip('.')) == 1 and not is_spaced_paragraph(source, paragraphs, i):
+                unconfirmed.add(len(chapters))
+            chapters.append({
+                'title': title,
+                'level': level,
+                'paragraph': i,
+                'offset': start,
+                'page': bisect.bisect_right(page_starts, i)
+            })
+    finally:
+        source.close()
+    return drop_unconfirmed_numerals(chapters, unconfirmed)
+
+def get_toc_index(book_id, book_file):
+    paragraphs, pages = get_page_index(book_id, book_file)
+    index = get_book_index(book_id, book_file, 'toc', lambda: {
+        'chapters': build_toc(book_file, paragraphs, pages)
+    }, params={'words_per_page': BOOK_WORDS_PER_PAGE, 'headings': 2})
+    return index['chapters']
+
+# Абзацы одной страницы (номер страницы с 1; титульная страница — на клиенте)
+def read_page(book_file, paragraphs, page):
+    # Часть длинного абзаца читается по своим байтовым границам, а не весь абзац
+    if len(page) == 6:
+        with open(os.path.join(BOOKS_DIR, book_file), 'rb') as f:
+            f.seek(page[4])
+            data = f.read(page[5] - page[4])
+        return [' '.join(data.decode('utf-8', errors='replace').split())]
+    return read_paragraphs(book_file, paragraphs, page[0], page[1] - page[0])
+
+# Потоковое чтение текста книги блоками (UTF-8 декодируется по частям,
+# поэтому многобайтные символы на границе блоков не ломаются)
+# f — файл или mmap из open_book_source()
+def iter_book_text(f, chunk_size=BOOK_STREAM_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = iter_source_chunks(f, chunk_size)
+    try:
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+    finally:
+        chunks.close()
+        f.close()
+
+# Текст книги как есть (байты файла уже в UTF-8), без декодирования
+def iter_book_bytes(f, chunk_size=BOOK_STREAM_CHUNK_SIZE):
+    chunks = iter_source_chunks(f, chunk_size)
+    try:
+        for chunk in chunks:
+            yield bytes(chunk)
+    finally:
+        chunks.close()
+        f.close()
+
+# Тот же ответ, что {'text', 'title', 'author'} через jsonify, но JSON
+# формируется по частям и весь текст книги в памяти не держится
+def iter_book_text_json(f, title, author):
+    yield '{"title": ' + json.dumps(title, ensure_ascii=False)
+    yield ', "author": ' + json.dumps(author, ensure_ascii=False)
+    yield ', "text": "'
+    for text in iter_book_text(f):
+        yield json.dumps(text, ensure_ascii=False)[1:-1]
+    yield '"}'
+
+# Заранее сжатые варианты книги (BOOK_INDEX_DIR/<id>/<тело>.<gz|br>):
+# 'text' — сам файл книги, 'json' — ответ /api/books/<id>/text.
+# Сжатие выполняется один раз при загрузке (или при первом обращении)
+BOOK_COMPRESSED_EXTENSIONS = {'br': 'br', 'gzip': 'gz'}
+
+def get_supported_book_encodings():
+    return [encoding for encoding in BOOK_COMPRESSED_EXTENSIONS if encoding != 'br' or brotli]
+
+def write_compressed_variant(chunks, path, encoding):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as out:
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as gz:
+                for chunk in chunks:
+                    gz.write(chunk)
         else:
-            book_file = None
-    
-    # Валидация обязательных полей
-    if not title or not author or not genre:
-        return jsonify({'error': 'title, author и genre обязательны'}), 400
-    
-    # Определяем формат файла
-    if book_file and book_file.filename and allowed_file(book_file.filename, ALLOWED_BOOK_EXTENSIONS):
-        file_format = book_file.filename.rsplit('.', 1)[1].lower()
-    else:
-        file_format = 'txt'  # По умолчанию
-    
-    # ID = название книги + формат
-    book_filename = create_book_filename(title, file_format)
-    book_id = book_filename  # ID включает формат: название.txt
-    
-    # Проверяем, не существует ли уже книга с таким ID
-    book_file_path = os.path.join(BOOKS_DIR, book_filename)
-    book_meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
-    
-    if os.path.exists(book_file_path) or os.path.exists(book_meta_path):
-        return jsonify({'error': f'Книга с названием "{title}" уже существует'}), 400
-    
-    # Сохраняем файл книги, если он есть
-    saved_filename = None
-    if book_file and book_file.filename:
-        try:
-            # Используем book_filename напрямую, чтобы соответствовать ID
-            # secure_filename может изменить имя, что приведет к несоответствию
-            filename = book_filename  # Используем то же имя, что и для ID
-            file_path = os.path.join(BOOKS_DIR, filename)
-            book_file.save(file_path)
-            saved_filename = filename
-        except Exception as e:
-            return jsonify({'error': f'Ошибка сохранения файла: {e}'}), 500
-    
-    # Создаем метаданные о книге
-    new_book = {
-        'id': book_id,
-        'title': title,
-        'author': author,
-        'genre': genre,
-        'description': description,
-        'cover': cover if cover else 'https://via.placeholder.com/150',
-        'added_by': session.get('username', 'admin'),
-        'added_at': str(Path(__file__).stat().st_mtime),
-        'book_file': saved_filename,
-        'file_format': file_format
-    }
-    
-    # Сохраняем метаданные
-    try:
-        with open(book_meta_path, 'w', encoding='utf-8') as f:
-            json.dump(new_book, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        # Если ошибка сохранения метаданных, удаляем файл
-        if saved_filename and os.path.exists(os.path.join(BOOKS_DIR, saved_filename)):
-            os.remove(os.path.join(BOOKS_DIR, saved_filename))
-        return jsonify({'error': f'Ошибка сохранения: {e}'}), 500
-    
-    return jsonify({'message': 'Книга добавлена', 'id': book_id, 'book': new_book})
-
-# API: Удалить книгу (только для админа)
-@app.route('/api/books', methods=['DELETE'])
-def delete_book():
-    if not session.get('is_admin'):
-        return jsonify({'error': 'Требуется авторизация администратора'}), 403
-    
-    book_id = request.args.get('id')
-    if not book_id:
-        return jsonify({'error': 'ID обязателен'}), 400
-    
-    # Ищем файлы книги по ID (метаданные и сам файл)
-    deleted = False
-    book_file_to_delete = None
-    
-    if os.path.exists(BOOKS_DIR):
-        # Ищем файл метаданных
-        meta_file = book_id + '.json'
-        meta_path = os.path.join(BOOKS_DIR, meta_file)
-        
-        if os.path.exists(meta_path):
-            try:
-                # Читаем метаданные, чтобы узнать имя файла книги
-                with open(meta_path, 'r', encoding='utf-8') as f:
-                    book_data = json.load(f)
-                    book_file_to_delete = book_data.get('book_file')
-                
-                # Удаляем метаданные
-                os.remove(meta_path)
-                deleted = True
-                
-                # Удаляем файл книги, если он есть
-                if book_file_to_delete:
-                    book_file_path = os.path.join(BOOKS_DIR, book_file_to_delete)
-                    if os.path.exists(book_file_path):
-                        os.remove(book_file_path)
-            except Exception as e:
-                return jsonify({'error': f'Ошибка удаления файла: {e}'}), 500
-    
-    if deleted:
-        return jsonify({'message': 'Книга удалена'})
-    
-    return jsonify({'error': 'Книга не найдена'}), 404
-
-# API: Регистрация
-@app.route('/api/register', methods=['POST'])
-def register():
-    data = request.json
-    username = data.get('username', '').strip()
-    password = data.get('password', '').strip()
-    
-    if not username or not password:
-        return jsonify({'error': 'Заполните все поля'}), 400
-    
-    # Проверяем в .env
-    env_users = get_users_from_env()
-    if any(u.get('username') == username for u in env_users):
-        return jsonify({'error': 'Пользователь с таким именем уже существует в системе (.env)'}), 400
-    
-    # Проверяем в файле пользователей
-    users = read_users()
-    if any(u.get('username') == username for u in users):
-        return jsonify({'error': 'Пользователь уже существует'}), 400
-    
-    # Добавляем нового пользователя
-    new_user = {
-        'username': username,
-        'password': password,
-        'created_at': str(Path(__file__).stat().st_mtime),
-        'role': 'user',
-        'is_admin': False,
-        'has_subscription': False
-    }
-    users.append(new_user)
-    
-    if save_users(users):
-        return jsonify({'message': f'Пользователь {username} зарегистрирован!'})
-    else:
-        return jsonify({'error': 'Ошибка сохранения пользователя'}), 500
-
-# API: Логин (для обычных пользователей)
-@app.route('/api/login', methods=['POST'])
-def login():
-    data = request.json
-    username = data.get('username', '').strip()
-    password = data.get('password', '').strip()
-    
-    if not username or not password:
-        return jsonify({'error': 'Заполните все поля'}), 400
-    
-    # Проверяем в .env
-    env_users = get_users_from_env()
-    for user in env_users:
-        if user.get('username') == username and user.get('password') == password:
-            session['username'] = username
-            session['is_user'] = True
-            return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'env'})
-    
-    # Проверяем в файле пользователей
-    users = read_users()
-    for user in users:
-        if user.get('username') == username and user.get('password') == password:
-            session['username'] = username
-            session['is_user'] = True
-            return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'file'})
-    
-    # Проверяем существование пользователя
-    if any(u.get('username') == username for u in env_users):
-        return jsonify({'error': 'Неверный пароль'}), 401
-    
-    return jsonify({'error': 'Пользователь не найден'}), 401
-
-# API: Настройки
-@app.route('/api/settings', methods=['GET'])
-def get_settings():
-    db = read_db()
-    settings = db.get('settings', {'background': None, 'backgroundType': 'default'})
-    backgrounds = get_available_backgrounds()
-    
-    # Добавляем стандартные фоны
-    backgrounds_list = [{
-        'name': bg,
-        'url': f'/static/backgrounds/{bg}'
-    } for bg in backgrounds]
-    
-    # Добавляем пользовательские фоны из папки
-    if os.path.exists(BACKGROUNDS_DIR):
-        for filename in os.listdir(BACKGROUNDS_DIR):
-            if allowed_file(filename, ALLOWED_IMAGE_EXTENSIONS):
-                # Проверяем, нет ли уже такого фона
-                if not any(bg['name'] == filename for bg in backgrounds_list):
-                    backgrounds_list.append({
-                        'name': filename,
-                        'url': f'/backgrounds/{filename}'
-                    })
-    
-    return jsonify({
-        'settings': settings,
-        'availableBackgrounds': backgrounds_list
-    })
-
-# API: Сохранить настройки
-@app.route('/api/settings', methods=['POST'])
-def save_settings():
-    db = read_db()
-    
-    # Проверяем, есть ли загрузка файла фона
-    if 'background_file' in request.files:
-        file = request.files['background_file']
-        if file and file.filename and allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(BACKGROUNDS_DIR, filename)
-            file.save(file_path)
-            
-            background_url = f'/backgrounds/{filename}'
-            
-            if 'settings' not in db:
-                db['settings'] = {}
-            
-            db['settings'].update({
-                'background': background_url,
-                'backgroundType': 'custom'
-            })
-            
-            save_db(db)
-            return jsonify({'message': 'Фон загружен и сохранен', 'settings': db['settings']})
-        else:
-            return jsonify({'error': 'Неподдерживаемый формат. Разрешены: png, jpg, jpeg, gif, svg, webp'}), 400
-    else:
-        # Обычное сохранение через JSON
-        data = request.json if request.is_json else request.form.to_dict()
-        
-        if 'settings' not in db:
-            db['settings'] = {}
-        
-        db['settings'].update({
-            'background': data.get('background'),
-            'backgroundType': data.get('backgroundType', 'default')
-        })
-        
-        save_db(db)
-        
-        return jsonify({'message': 'Настройки сохранены', 'settings': db['settings']})
-
-# Статические файлы фонов
-@app.route('/backgrounds/<filename>')
-def serve_background(filename):
-    return send_from_directory(BACKGROUNDS_DIR, filename)
-
-# API: Получить всех пользователей (только для админа)
-@app.route('/api/users', methods=['GET'])
-@admin_required
-def get_all_users():
-    users = read_users()
-    env_users = get_users_from_env()
-    
-    # Объединяем пользователей из файла и .env
-    all_users = []
-    
-    # Добавляем пользователей из .env
-    for env_user in env_users:
-        all_users.append({
-            'username': env_user.get('username'),
-            'source': 'env',
-            'is_admin': False,
-            'has_subscription': False,
-            'created_at': None
-        })
-    
-    # Добавляем пользователей из файла
-    for user in users:
-        all_users.append({
-            'username': user.get('username'),
-            'source': 'file',
-            'is_admin': user.get('is_admin', False),
-            'has_subscription': user.get('has_subscription', False),
-            'created_at': user.get('created_at')
-        })
-    
-    return jsonify(all_users)
-
-# API: Обновить права пользователя (только для админа)
-@app.route('/api/users/<path:username>', methods=['PUT'])
-@admin_required
-def update_user(username):
-    from urllib.parse import unquote
-    username = unquote(username)
-    
-    data = request.json
-    is_admin = data.get('is_admin')
-    has_subscription = data.get('has_subscription')
-    
-    users = read_users()
-    user_found = False
-    
-    for user in users:
-        if user.get('username') == username:
-            # Обновляем только переданные поля
-            if is_admin is not None:
-                user['is_admin'] = is_admin
-            if has_subscription is not None:
-                user['has_subscription'] = has_subscription
-            user_found = True
-            break
-    
-    if not user_found:
-        return jsonify({'error': 'Пользователь не найден'}), 404
-    
-    if save_users(users):
-        return jsonify({'message': 'Права пользователя обновлены', 'user': {
-            'username': username,
-            'is_admin': user.get('is_admin', False),
-            'has_subscription': user.get('has_subscription', False)
-        }})
-    else:
-        return jsonify({'error': 'Ошибка сохранения'}), 500
-
-# Google OAuth: Начало авторизации
-@app.route('/api/auth/google', methods=['GET'])
-def google_auth():
-    # Получаем URL для редиректа
-    redirect_uri = request.args.get('redirect_uri', request.url_root.rstrip('/') + '/api/auth/google/callback')
-    
-    # Получаем credentials из .env
-    client_id = os.getenv('GOOGLE_CLIENT_ID')
-    client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
-    
-    if not client_id:
-        return jsonify({'error': 'Google OAuth не настроен. Добавьте GOOGLE_CLIENT_ID в .env'}), 400
-    
-    # Сохраняем redirect_uri в сессии
-    session['oauth_redirect_uri'] = redirect_uri
-    
-    # Формируем URL для авторизации Google
-    auth_url = (
-        'https://accounts.google.com/o/oauth2/v2/auth?'
-        + urlencode({
-            'client_id': client_id,
-            'redirect_uri': request.url_root.rstrip('/') + '/api/auth/google/callback',
-            'response_type': 'code',
-            'scope': 'openid email profile',
-            'access_type': 'online',
-            'prompt': 'select_account'
-        })
-    )
-    
-    return redirect(auth_url)
-
-# Google OAuth: Callback
-@app.route('/api/auth/google/callback', methods=['GET'])
-def google_auth_callback():
-    code = request.args.get('code')
-    error = request.args.get('error')
-    
-    if error:
-        return redirect('/?error=' + error)
-    
-    if not code:
-        return redirect('/?error=no_code')
-    
-    client_id = os.getenv('GOOGLE_CLIENT_ID')
-    client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
-    
-    if not client_id or not client_secret:
-        return redirect('/?error=oauth_not_configured')
-    
-    # Обмениваем код на токен
-    token_url = 'https://oauth2.googleapis.com/token'
-    redirect_uri = request.url_root.rstrip('/') + '/api/auth/google/callback'
-    
-    token_data = {
-        'code': code,
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'redirect_uri': redirect_uri,
-        'grant_type': 'authorization_code'
-    }
-    
-    try:
-        token_response = requests.post(token_url, data=token_data)
-        token_response.raise_for_status()
-        tokens = token_response.json()
-        access_token = tokens.get('access_token')
-        
-        if not access_token:
-            return redirect('/?error=no_token')
-        
-        # Получаем информацию о пользователе
-        user_info_url = 'https://www.googleapis.com/oauth2/v2/userinfo'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        user_response = requests.get(user_info_url, headers=headers)
-        user_response.raise_for_status()
-        user_info = user_response.json()
-        
-        email = user_info.get('email')
-        name = user_info.get('name', email)
-        
-        if not email:
-            return redirect('/?error=no_email')
-        
-        # Проверяем или создаем пользователя
-        users = read_users()
-        user_found = False
-        
-        for user in users:
-            if user.get('email') == email or user.get('username') == email:
-                user_found = True
-                # Обновляем информацию
-                user['username'] = email
-                user['email'] = email
-                user['name'] = name
-                user['auth_method'] = 'google'
-                break
-        
-        if not user_found:
-            # Создаем нового пользователя
-            new_user = {
-                'username': email,
-                'email': email,
-                'name': name,
-                'password': None,  # Пароль не нужен для Google OAuth
-                'created_at': str(Path(__file__).stat().st_mtime),
-                'role': 'user',
-                'is_admin': False,
-                'has_subscription': False,
-                'auth_method': 'google'
-            }
-            users.append(new_user)
-            save_users(users)
-        
-        # Устанавливаем сессию
-        session['username'] = email
-        session['is_user'] = True
-        session['user_name'] = name
-        session['auth_method'] = 'google'
-        
-        # Проверяем, является ли пользователь админом
-        is_admin_user = False
-        for user in users:
-            if user.get('username') == email and user.get('is_admin'):
-                is_admin_user = True
-                break
-        
-        # Также проверяем, является ли это админ из .env
-        admin_username = os.getenv('ADMIN_USERNAME', 'admin').strip()
-        if email == admin_username:
-            is_admin_user = True
-        
-        if is_admin_user:
-            session['is_admin'] = True
-        
-        # Редиректим обратно
-        redirect_uri = session.pop('oauth_redirect_uri', '/')
-        return redirect(redirect_uri)
-        
-    except Exception as e:
-        print(f'Ошибка Google OAuth: {e}')
-        return redirect('/?error=oauth_error')
-
-if __name__ == '__main__':
-    init_db()
-    print("\n" + "="*50)
-    print("Сервер запущен!")
-    print("Откройте браузер: http://localhost:5000")
-    print("Для остановки нажмите Ctrl+C")
-    print("="*50 + "\n")
-    app.run(debug=True, host='127.0.0.1', port=5000)
-
-
-from werkzeug.utils import secure_filename
-import json
-import os
-import re
-from pathlib import Path
-from dotenv import load_dotenv
-from urllib.parse import urlencode, parse_qs
-import requests
-
-# Загрузка переменных окружения из .env
-load_dotenv()
-
-app = Flask(__name__)
-app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production-12345')
-
-# Определяем файлы для разных серверов
-is_vercel = os.getenv('VERCEL') or os.getenv('VERCEL_ENV')
-
-if is_vercel:
-    # Для Vercel
-    DB_PATH = '/tmp/database.json'
-    USERS_PATH = '/tmp/users.json'
-    BOOKS_DIR = '/tmp/books'
-    BACKGROUNDS_DIR = '/tmp/backgrounds'
-else:
-    # Для localhost
-    DB_PATH = 'database.json'
-    USERS_PATH = 'users.json'
-    BOOKS_DIR = 'books'
-    BACKGROUNDS_DIR = 'static/backgrounds'
-
-# Создаем папки
-if not os.path.exists(BOOKS_DIR):
-    os.makedirs(BOOKS_DIR)
-if not os.path.exists(BACKGROUNDS_DIR):
-    os.makedirs(BACKGROUNDS_DIR)
-
-# Настройки загрузки файлов
-ALLOWED_BOOK_EXTENSIONS = {'txt'}
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'svg', 'webp'}
-UPLOAD_FOLDER = BOOKS_DIR
-MAX_UPLOAD_SIZE = 16 * 1024 * 1024  # 16MB
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
-
-def allowed_file(filename, extensions):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
-
-# Инициализация базы данных
-def init_db():
-    if not os.path.exists(DB_PATH):
-        default_data = {
-            "settings": {
-                "background": None,
-                "backgroundType": "default"
-            }
+            compressor = brotli.Compressor(quality=9)
+            for chunk in chunks:
+                out.write(compressor.process(chunk))
+            out.write(compressor.finish())
+    os.replace(temp_path, path)
+
+def iter_file_chunks(file_path, chunk_size=BOOK_STREAM_CHUNK_SIZE):
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def build_compressed_variants(book_id, book_file, title, author):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    bodies = {
+        'text': lambda: iter_file_chunks(file_path),
+        'json': lambda: (part.encode('utf-8') for part in
+                         iter_book_text_json(open(file_path, 'rb'), title, author))
+    }
+    os.makedirs(os.path.join(BOOK_INDEX_DIR, book_id), exist_ok=True)
+    variants = {}
+    for body, chunks in bodies.items():
+        variants[body] = {}
+        for encoding in get_supported_book_encodings():
+            filename = f'{body}.{BOOK_COMPRESSED_EXTENSIONS[encoding]}'
+            write_compressed_variant(chunks(), os.path.join(BOOK_INDEX_DIR, book_id, filename), encoding)
+            variants[body][encoding] = filename
+    return {'variants': variants}
+
+def get_compressed_variants(book_id, book_file, book_data):
+    title, author = book_display_info(book_data, book_id)
+    index = get_book_index(
+        book_id, book_file, 'compressed',
+        lambda: build_compressed_variants(book_id, book_file, title, author),
+        params={'title': title, 'author': author, 'encodings': get_supported_book_encodings()}
+    )
+    return index['variants']
+
+# Ответ со сжатым вариантом, если клиент его принимает (иначе None)
+# etag — строгий ETag несжатого содержимого; к нему добавляется кодировка
+def send_compressed_book(book_id, book_file, book_data, body, content_type, etag=True):
+    encoding = request.accept_encodings.best_match(get_supported_book_encodings())
+    if not encoding:
+        return None
+    filename = get_compressed_variants(book_id, book_file, book_data)[body].get(encoding)
+    if not filename:
+        return None
+    if isinstance(etag, str):
+        etag = f'{etag}-{encoding}'
+    response = send_from_directory(os.path.join(BOOK_INDEX_DIR, book_id), filename,
+                                   mimetype=content_type, etag=etag)
+    response.headers['Content-Type'] = content_type
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# LRU-кэш готовых тел ответов с текстом книг, ограниченный суммарным размером.
+# Ключ включает размер и mtime файла, поэтому измененная книга не отдается из кэша.
+# Кэшируются только несжатые ответы - для клиентов без gzip/br. Браузеры получают
+# заранее сжатые файлы (send_compressed_book), их держит кэш страниц ОС
+_text_cache_lock = threading.Lock()
+_text_cache = {
+    'entries': OrderedDict(),  # ключ -> bytes (в конце — недавно использованные)
+    'bytes': 0,
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0
+}
+
+def text_cache_get(key):
+    with _text_cache_lock:
+        body = _text_cache['entries'].get(key)
+        if body is None:
+            _text_cache['misses'] += 1
+            return None
+        _text_cache['entries'].move_to_end(key)
+        _text_cache['hits'] += 1
+        return body
+
+def text_cache_put(key, body):
+    if len(body) > min(BOOK_TEXT_CACHE_MAX_ITEM_BYTES, BOOK_TEXT_CACHE_MAX_BYTES):
+        return
+    with _text_cache_lock:
+        entries = _text_cache['entries']
+        old = entries.pop(key, None)
+        if old is not None:
+            _text_cache['bytes'] -= len(old)
+        entries[key] = body
+        _text_cache['bytes'] += len(body)
+        while _text_cache['bytes'] > BOOK_TEXT_CACHE_MAX_BYTES:
+            _, evicted = entries.popitem(last=False)
+            _text_cache['bytes'] -= len(evicted)
+            _text_cache['evictions'] += 1
+
+def text_cache_forget(book_id):
+    with _text_cache_lock:
+        for key in [key for key in _text_cache['entries'] if key[0] == book_id]:
+            _text_cache['bytes'] -= len(_text_cache['entries'].pop(key))
+
+def get_text_cache_stats():
+    with _text_cache_lock:
+        return {
+            'entries': len(_text_cache['entries']),
+            'bytes': _text_cache['bytes'],
+            'max_bytes': BOOK_TEXT_CACHE_MAX_BYTES,
+            'hits': _text_cache['hits'],
+            'misses': _text_cache['misses'],
+            'evictions': _text_cache['evictions'],
+            'encoding': 'identity'  # сжатые ответы идут мимо кэша
         }
-        save_db(default_data)
-
-# Инициализация файла пользователей
-def init_users():
-    if not os.path.exists(USERS_PATH):
-        default_users = []
-        save_users(default_users)
 
-# Чтение пользователей
-def read_users():
-    init_users()
+# SHA-256 файла книги (считается потоково один раз и хранится как индекс 'hash')
+def hash_book_file(file_path):
+    digest = hashlib.sha256()
+    source = open_book_source(file_path)
+    try:
+        if isinstance(source, mmap.mmap):
+            digest.update(source)
+        else:
+            for chunk in iter_source_chunks(source):
+                digest.update(chunk)
+    finally:
+        source.close()
+    return digest.hexdigest()
+
+def get_book_hash(book_id, book_file):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    index = get_book_index(book_id, book_file, 'hash', lambda: {
+        'sha256': hash_book_file(file_path)
+    })
+    return index['sha256']
+
+# Запомнить хэш, уже посчитанный при загрузке, чтобы не читать файл повторно
+def remember_book_hash(book_id, book_file, sha256):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    index = save_book_index(book_id, 'hash', file_path, {'sha256': sha256, 'params': None})
+    _book_indexes[(book_id, 'hash')] = index
+
+# Содержимое книг хранится один раз в BOOK_BLOBS_DIR/<sha256>.<формат>,
+# а в BOOKS_DIR лежит жесткая ссылка на него под именем книги
+# (если файловая система не поддерживает ссылки — копия)
+def get_book_blob_path(sha256, file_format):
+    return os.path.join(BOOK_BLOBS_DIR, f'{sha256}.{file_format}')
+
+# Ошибки os.link, при которых файловая система просто не умеет жесткие ссылки
+BOOK_LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+# Потоковая запись загруженного файла в хранилище blob-ов: блоками во временный
+# файл с вычислением SHA-256 и размера по ходу. Возвращает (sha256, размер, дубликат ли)
+def store_book_blob(stream, file_format):
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=BOOK_BLOBS_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(BOOK_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        blob_path = get_book_blob_path(sha256, file_format)
+        duplicate = os.path.exists(blob_path)
+        if duplicate:
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, blob_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return sha256, size, duplicate
+
+# Перенести готовый файл в хранилище blob-ов (переименованием, без копирования).
+# Если такой blob уже есть, файл остается на месте. sha256 считается, если не передан
+def move_book_blob(file_path, file_format, sha256=None):
+    if sha256 is None:
+        sha256 = hash_book_file(file_path)
+    size = os.path.getsize(file_path)
+    blob_path = get_book_blob_path(sha256, file_format)
+    duplicate = os.path.exists(blob_path)
+    if not duplicate:
+        try:
+            os.replace(file_path, blob_path)
+        except OSError as e:
+            # Другая файловая система: копируем потоком
+            if e.errno != errno.EXDEV:
+                raise
+            with open(file_path, 'rb') as f:
+                return store_book_blob(f, file_format)
+    return sha256, size, duplicate
+
+# Копия blob-а под именем книги. Файл создается с O_EXCL: существующий файл
+# (ссылку на чужой blob) перезаписывать нельзя
+def copy_book_blob(blob_path, file_path):
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(blob_path, 'rb') as source:
+            shutil.copyfileobj(source, out, BOOK_STREAM_CHUNK_SIZE)
+    except Exception:
+        os.remove(file_path)
+        raise
+
+# Файл книги в BOOKS_DIR: жесткая ссылка на blob, а если ссылки не поддерживаются - копия.
+# Если файл с таким именем уже есть (книга с тем же названием добавлена параллельно),
+# бросается FileExistsError, а blob освобождается
+def link_book_blob(sha256, book_filename, file_format):
+    blob_path = get_book_blob_path(sha256, file_format)
+    file_path = os.path.join(BOOKS_DIR, book_filename)
+    try:
+        try:
+            os.link(blob_path, file_path)
+        except OSError as e:
+            if isinstance(e, FileExistsError) or e.errno not in BOOK_LINK_UNSUPPORTED_ERRNOS:
+                raise
+            copy_book_blob(blob_path, file_path)
+    except FileExistsError:
+        release_book_blob(sha256, file_format)
+        raise
+
+# Сохранить загруженный файл книги: blob + файл под именем книги
+def store_book_upload(stream, book_filename, file_format):
+    sha256, size, duplicate = store_book_blob(stream, file_format)
+    link_book_blob(sha256, book_filename, file_format)
+    return sha256, size, duplicate
+
+# Удалить blob, если на него больше никто не ссылается
+def release_book_blob(sha256, file_format='txt'):
+    blob_path = get_book_blob_path(sha256, file_format)
+    try:
+        if os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+    except OSError:
+        pass
+
+# Удалить файл книги и ее blob, если на него больше никто не ссылается
+def remove_book_file(book_file, sha256=None, file_format='txt'):
+    file_path = os.path.join(BOOKS_DIR, book_file)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    if sha256:
+        release_book_blob(sha256, file_format)
+
+# Загрузка книг по частям. Каждая загрузка - папка UPLOADS_DIR/<id> с описанием
+# upload.json, файлом data.part нужного размера и отметкой <n>.sha256 на каждую
+# принятую часть. Части пишутся по своему смещению, поэтому их можно
+# присылать повторно и в любом порядке, а прерванная загрузка продолжается
+def get_upload_dir(upload_id):
+    return os.path.join(UPLOADS_DIR, upload_id)
+
+def read_upload(upload_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+        return None
     try:
-        with open(USERS_PATH, 'r', encoding='utf-8') as f:
+        with open(os.path.join(get_upload_dir(upload_id), 'upload.json'), 'r', encoding='utf-8') as f:
             return json.load(f)
-    except:
-        return []
+    except (OSError, ValueError):
+        return None
+
+# Принятые части: {номер: sha256}
+def get_upload_chunks(upload_id):
+    chunks = {}
+    for filename in os.listdir(get_upload_dir(upload_id)):
+        if filename.endswith('.sha256'):
+            with open(os.path.join(get_upload_dir(upload_id), filename), 'r', encoding='utf-8') as f:
+                chunks[int(filename[:-len('.sha256')])] = f.read().strip()
+    return chunks
+
+def get_upload_status(upload):
+    received = sorted(get_upload_chunks(upload['id']))
+    return dict(upload, received=received,
+                missing=sorted(set(range(upload['total_chunks'])) - set(received)))
+
+def create_upload(filename, size, sha256, created_by):
+    total_chunks = max(1, -(-size // UPLOAD_CHUNK_SIZE))
+    upload = {
+        'id': uuid.uuid4().hex,
+        'filename': filename,
+        'file_format': filename.rsplit('.', 1)[1].lower(),
+        'size': size,
+        'sha256': sha256,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'total_chunks': total_chunks,
+        'created_by': created_by,
+        'created_at': time.time()
+    }
+    upload_dir = get_upload_dir(upload['id'])
+    os.makedirs(upload_dir)
+    with open(os.path.join(upload_dir, 'data.part'), 'wb') as f:
+        f.truncate(size)
+    with open(os.path.join(upload_dir, 'upload.json'), 'w', encoding='utf-8') as f:
+        json.dump(upload, f, ensure_ascii=False)
+    return upload
+
+# Записать часть n из потока; ValueError, если размер или контрольная сумма не совпали
+def write_upload_chunk(upload, n, stream, expected_sha256):
+    offset = n * upload['chunk_size']
+    expected_size = min(upload['chunk_size'], upload['size'] - offset)
+    upload_dir = get_upload_dir(upload['id'])
+    marker_path = os.path.join(upload_dir, f'{n}.sha256')
+    # Повторная отправка части: старая отметка недействительна до проверки новой
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+    
+    digest = hashlib.sha256()
+    written = 0
+    with open(os.path.join(upload_dir, 'data.part'), 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = stream.read(min(BOOK_STREAM_CHUNK_SIZE, expected_size - written + 1))
+            if not block:
+                break
+            written += len(block)
+            if written > expected_size:
+                raise ValueError(f'Часть {n} больше ожидаемого размера ({expected_size} байт)')
+            digest.update(block)
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    if written != expected_size:
+        raise ValueError(f'Часть {n}: получено {written} байт из {expected_size}')
+    if digest.hexdigest() != expected_sha256:
+        raise ValueError(f'Часть {n}: контрольная сумма не совпадает')
+    
+    fd, temp_path = tempfile.mkstemp(dir=upload_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(expected_sha256)
+    os.replace(temp_path, marker_path)
+
+def remove_upload(upload_id):
+    shutil.rmtree(get_upload_dir(upload_id), ignore_errors=True)
+
+# Удалить брошенные загрузки
+def cleanup_expired_uploads():
+    now = time.time()
+    for upload_id in os.listdir(UPLOADS_DIR):
+        upload = read_upload(upload_id)
+        if upload is None or now - upload.get('created_at', 0) > UPLOAD_EXPIRE_SECONDS:
+            remove_upload(upload_id)
+
+# Фоновые задачи обработки книг. Каждая задача хранится в JOBS_DIR/<id>.json,
+# поэтому ее статус виден всем процессам, а незавершенные задачи
+# подхватываются заново после перезапуска.
+# Перед запуском процесс берет аренду задачи (JOBS_DIR/<id>.lease с владельцем и
+# сроком) и продлевает ее, пока задача идет. Задачу с живой арендой другие
+# процессы не трогают; аренда упавшего процесса истекает, и задачу забирает другой
+JOB_LEASE_SECONDS = 60
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 7 * 24 * 60 * 60))
+JOB_PRUNE_INTERVAL = 60 * 60
+_jobs_lock = threading.Lock()
+_job_queue = queue.Queue()
+_job_workers = []
+_job_queued_ids = set()  # задачи в очереди этого процесса
+_job_leases = set()      # задачи, аренду которых держит этот процесс
+
+# Шаги обработки загруженной книги (все идемпотентны: готовые индексы не пересчитываются)
+INGEST_STEPS = [
+    ('pages', lambda book_id, book_file, book_data: get_page_index(book_id, book_file)),
+    ('toc', lambda book_id, book_file, book_data: get_toc_index(book_id, book_file)),
+    ('compressed', lambda book_id, book_file, book_data: get_compressed_variants(book_id, book_file, book_data))
+]
+
+def get_job_path(job_id, finished=False):
+    return os.path.join(FINISHED_JOBS_DIR if finished else JOBS_DIR, job_id + '.json')
+
+def job_finished(job):
+    return job.get('status') in ('done', 'failed')
+
+# Завершенная задача переезжает в FINISHED_JOBS_DIR: поиск незавершенных задач
+# читает только JOBS_DIR, а старые завершенные удаляются через JOB_RETENTION_SECONDS
+def save_job(job):
+    job['updated_at'] = time.time()
+    fd, temp_path = tempfile.mkstemp(dir=JOBS_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(temp_path, get_job_path(job['id'], job_finished(job)))
+    if job_finished(job):
+        try:
+            os.remove(get_job_path(job['id']))
+        except FileNotFoundError:
+            pass
 
-# Сохранение пользователей
-def save_users(users):
+def read_job(job_id):
+    for finished in (False, True):
+        try:
+            with open(get_job_path(job_id, finished), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            continue
+    return None
+
+def run_ingest_job(job):
+    book_id = job['book_id']
+    job['status'] = 'running'
+    for done, (step, run_step) in enumerate(INGEST_STEPS):
+        job['progress'] = {'step': step, 'done': done, 'total': len(INGEST_STEPS)}
+        save_job(job)
+        book_data, book_file = resolve_book(book_id)
+        if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+            raise FileNotFoundError(f'Файл книги не найден. ID: {book_id}')
+        run_step(book_id, book_file, book_data)
+    job['progress'] = {'step': None, 'done': len(INGEST_STEPS), 'total': len(INGEST_STEPS)}
+
+# Метаданные новой книги (общие для формы добавления и массового импорта)
+def build_book_meta(book_id, title, author, genre, description, cover, cover_thumbs, added_by, book_file, file_format):
+    return {
+        'id': book_id,
+        'title': title,
+        'author': author,
+        'genre': genre,
+        'description': description,
+        'cover': cover,
+        'cover_thumbs': cover_thumbs,
+        'added_by': added_by,
+        'added_at': str(time.time()),
+        'book_file': book_file,
+        'file_format': file_format
+    }
+
+# Массовый импорт книг из папки или ZIP-архива с .txt файлами.
+# Манифест (CSV или JSON) задает title/author/genre/description по имени файла;
+# без манифеста название берется из имени файла
+IMPORT_MANIFEST_NAMES = ('manifest.csv', 'manifest.json')
+IMPORT_DEFAULT_AUTHOR = 'Неизвестен'
+IMPORT_DEFAULT_GENRE = 'Без жанра'
+
+# Прочитать манифест: {имя файла: {title, author, genre, description}}
+def read_import_manifest(manifest_path):
+    if manifest_path.lower().endswith('.json'):
+        with open(manifest_path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            rows = [dict(meta, file=filename) for filename, meta in data.items()]
+        else:
+            rows = data
+    else:
+        with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+    
+    manifest = {}
+    for row in rows:
+        filename = os.path.basename((row.get('file') or '').strip())
+        if filename:
+            manifest[filename] = {
+                key: (row.get(key) or '').strip()
+                for key in ('title', 'author', 'genre', 'description')
+            }
+    return manifest
+
+# Распаковать .txt файлы и манифест из архива (пути внутри архива не используются)
+def extract_import_archive(archive_path, target_dir):
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            filename = os.path.basename(info.filename)
+            if info.is_dir() or not filename:
+                continue
+            if not allowed_file(filename, ALLOWED_BOOK_EXTENSIONS) and filename.lower() not in IMPORT_MANIFEST_NAMES:
+                continue
+            target_path = os.path.join(target_dir, filename)
+            if os.path.exists(target_path):
+                print(f'Пропущен повторяющийся файл архива: {info.filename}')
+                continue
+            with archive.open(info) as src, open(target_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, BOOK_STREAM_CHUNK_SIZE)
+
+# Импорт одной книги (выполняется в процессе пула): файл, метаданные и индексы
+def import_book_file(file_path, title, author, genre, description, added_by):
+    book_filename = create_book_filename(title, 'txt')
+    book_id = book_filename
+    result = {'file': os.path.basename(file_path), 'id': book_id, 'status': 'added', 'error': None}
+    exists_error = f'Книга с названием "{title}" уже существует'
     try:
-        with open(USERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-        return True
+        if os.path.exists(os.path.join(BOOKS_DIR, book_filename)) or storage.get_book(book_id) is not None:
+            result['status'] = 'skipped'
+            result['error'] = exists_error
+            return result
+        
+        try:
+            with open(file_path, 'rb') as f:
+                sha256, size, duplicate = store_book_upload(f, book_filename, 'txt')
+        except FileExistsError:
+            result['status'] = 'skipped'
+            result['error'] = exists_error
+            return result
+        book = build_book_meta(book_id, title, author, genre, description, DEFAULT_COVER, {},
+                               added_by, book_filename, 'txt')
+        book['sha256'] = sha256
+        book['size'] = size
+        try:
+            remember_book_hash(book_id, book_filename, sha256)
+            save_book_meta(book)
+        except Exception:
+            remove_book_file(book_filename, sha256, 'txt')
+            raise
+        
+        # Индексы строятся здесь же, параллельно с остальными книгами
+        for step, run_step in INGEST_STEPS:
+            try:
+                run_step(book_id, book_filename, book)
+            except Exception as e:
+                print(f'Ошибка шага {step} для книги {book_id}: {e}')
+        result['book'] = book
     except Exception as e:
-        print(f'Ошибка сохранения пользователей: {e}')
-        return False
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    return result
 
-# Чтение базы данных
-def read_db():
-    init_db()
+# Импортировать папку или ZIP-архив; каталог обновляется один раз в конце
+def bulk_import(source, manifest_path=None, workers=None, added_by='admin', progress=None):
+    temp_dir = None
     try:
-        with open(DB_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return {"users": [], "books": [], "settings": {"background": None}}
-
-# Сохранение базы данных
-def save_db(data):
-    with open(DB_PATH, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-# Получить пользователей из .env
-def get_users_from_env():
-    users_env = os.getenv('LIBRARY_USERS', '')
-    users = []
-    if users_env:
-        for pair in users_env.split(','):
-            pair = pair.strip()
-            if ':' in pair:
-                username, password = pair.split(':', 1)
-                users.append({'username': username.strip(), 'password': password.strip()})
-    return users
+        if os.path.isdir(source):
+            source_dir = source
+        else:
+            temp_dir = tempfile.mkdtemp(prefix='import-')
+            extract_import_archive(source, temp_dir)
+            source_dir = temp_dir
+        
+        if not manifest_path:
+            for name in IMPORT_MANIFEST_NAMES:
+                if os.path.exists(os.path.join(source_dir, name)):
+                    manifest_path = os.path.join(source_dir, name)
+                    break
+        manifest = read_import_manifest(manifest_path) if manifest_path else {}
+        
+        file_paths = []
+        for root, dirs, filenames in os.walk(source_dir):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if allowed_file(filename, ALLOWED_BOOK_EXTENSIONS):
+                    file_paths.append(os.path.join(root, filename))
+        
+        # ID назначаются заранее, чтобы одинаковые названия в пакете не гонялись друг с другом
+        results = []
+        tasks = []
+        batch_ids = set()
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            meta = manifest.get(filename, {})
+            title = meta.get('title') or os.path.splitext(filename)[0].replace('_', ' ').strip()
+            book_id = create_book_filename(title, 'txt')
+            if book_id in batch_ids:
+                results.append({'file': filename, 'id': book_id, 'status': 'skipped',
+                                'error': f'Повторяющееся название в пакете: "{title}"'})
+                continue
+            batch_ids.add(book_id)
+            tasks.append((file_path, title, meta.get('author') or IMPORT_DEFAULT_AUTHOR,
+                          meta.get('genre') or IMPORT_DEFAULT_GENRE, meta.get('description', ''), added_by))
+        
+        total = len(file_paths)
+        catalog_stamp = get_catalog_stamp()
+        if progress:
+            progress(len(results), total)
+        workers = max(1, workers or os.cpu_count() or 1)
+        if workers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                results.append(import_book_file(*task))
+                if progress:
+                    progress(len(results), total)
+        else:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context) as pool:
+                futures = [pool.submit(import_book_file, *task) for task in tasks]
+                for future in as_completed(futures):
+                    results.append(future.result())
+                    if progress:
+                        progress(len(results), total)
+        
+        added = [result.pop('book') for result in results if result['status'] == 'added']
+        if added:
+            catalog_put_many(added, catalog_stamp)
+        return {
+            'total': total,
+            'added': len(added),
+            'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+            'failed': sum(1 for result in results if result['status'] == 'failed'),
+            'books': sorted(results, key=lambda result: result['file'])
+        }
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-# Получить доступные фоны
-def get_available_backgrounds():
-    is_vercel = os.getenv('VERCEL') or os.getenv('VERCEL_ENV')
+def run_bulk_import_job(job):
+    job['status'] = 'running'
+    last_saved = [0.0]
     
-    if is_vercel:
-        backgrounds = os.getenv('VERCEL_BACKGROUNDS', 'space1.svg,space2.svg,space3.svg')
-    else:
-        backgrounds = os.getenv('LOCAL_BACKGROUNDS', 'local1.svg,local2.svg,local3.svg')
+    def report(done, total):
+        job['progress'] = {'step': 'import', 'done': done, 'total': total}
+        # Не переписываем файл задачи на каждую книгу
+        if done == total or time.time() - last_saved[0] >= 1:
+            save_job(job)
+            last_saved[0] = time.time()
     
-    return [bg.strip() for bg in backgrounds.split(',') if bg.strip()]
+    try:
+        job['result'] = bulk_import(job['source'], job.get('manifest'), added_by=job.get('added_by', 'admin'), progress=report)
+    finally:
+        shutil.rmtree(job['upload_dir'], ignore_errors=True)
+
+JOB_HANDLERS = {
+    'ingest_book': run_ingest_job,
+    'bulk_import': run_bulk_import_job,
+    'background_variants': run_background_job,
+    'migrate_covers': run_cover_migration_job
+}
+
+def get_job_lease_path(job_id):
+    return os.path.join(JOBS_DIR, job_id + '.lease')
+
+# Владелец аренды: процесс (pid меняется после fork)
+def get_job_owner():
+    return f'{os.getpid()}:{_job_owner_token}'
+
+_job_owner_token = uuid.uuid4().hex
+
+def read_job_lease(job_id):
+    try:
+        with open(get_job_lease_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def job_lease_active(lease):
+    return lease is not None and lease.get('expires', 0) > time.time()
+
+# Взять или продлить аренду задачи; False, если ее держит другой процесс.
+# Все аренды меняются под одной межпроцессной блокировкой
+def claim_job(job_id):
+    with lock_file(os.path.join(JOBS_DIR, 'leases')):
+        lease = read_job_lease(job_id)
+        if job_lease_active(lease) and lease.get('owner') != get_job_owner():
+            return False
+        write_json_atomic(get_job_lease_path(job_id), {
+            'owner': get_job_owner(),
+            'expires': time.time() + JOB_LEASE_SECONDS
+        })
+    with _jobs_lock:
+        _job_leases.add(job_id)
+    return True
+
+def release_job(job_id):
+    with _jobs_lock:
+        _job_leases.discard(job_id)
+    with lock_file(os.path.join(JOBS_DIR, 'leases')):
+        lease = read_job_lease(job_id)
+        if lease is not None and lease.get('owner') == get_job_owner():
+            os.remove(get_job_lease_path(job_id))
+
+def enqueue_job(job):
+    with _jobs_lock:
+        if job['id'] in _job_queued_ids:
+            return
+        _job_queued_ids.add(job['id'])
+    _job_queue.put(job)
+
+# Незавершенные задачи: новые, а также запущенные процессом, аренда которого истекла
+def enqueue_pending_jobs():
+    for filename in os.listdir(JOBS_DIR):
+        if filename.endswith('.json'):
+            job = read_job(filename[:-len('.json')])
+            if job and job_finished(job):
+                # Задача, завершенная до появления FINISHED_JOBS_DIR
+                os.replace(get_job_path(job['id']), get_job_path(job['id'], True))
+            elif (job and job.get('status') in ('queued', 'running')
+                    and not job_lease_active(read_job_lease(job['id']))):
+                enqueue_job(job)
+
+# Удалить завершенные задачи старше JOB_RETENTION_SECONDS
+def prune_finished_jobs():
+    expire_before = time.time() - JOB_RETENTION_SECONDS
+    for filename in os.listdir(FINISHED_JOBS_DIR):
+        path = os.path.join(FINISHED_JOBS_DIR, filename)
+        try:
+            if os.stat(path).st_mtime < expire_before:
+                os.remove(path)
+        except OSError:
+            pass
+
+# Продление аренд выполняемых задач и периодический поиск брошенных задач
+def job_lease_keeper():
+    last_scan = last_prune = time.time()
+    while True:
+        time.sleep(JOB_LEASE_SECONDS / 3)
+        with _jobs_lock:
+            job_ids = list(_job_leases)
+        for job_id in job_ids:
+            try:
+                claim_job(job_id)
+            except Exception as e:
+                print(f'Ошибка продления аренды задачи {job_id}: {e}')
+        if time.time() - last_scan >= JOB_LEASE_SECONDS:
+            last_scan = time.time()
+            try:
+                enqueue_pending_jobs()
+            except Exception as e:
+                print(f'Ошибка поиска незавершенных задач: {e}')
+        if time.time() - last_prune >= JOB_PRUNE_INTERVAL:
+            last_prune = time.time()
+            try:
+                prune_finished_jobs()
+            except Exception as e:
+                print(f'Ошибка удаления старых задач: {e}')
+
+def job_worker():
+    while True:
+        job = _job_queue.get()
+        with _jobs_lock:
+            _job_queued_ids.discard(job['id'])
+        try:
+            claimed = claim_job(job['id'])
+        except Exception as e:
+            print(f'Ошибка аренды задачи {job["id"]}: {e}')
+            claimed = False
+        # Задачу уже выполняет другой процесс
+        if not claimed:
+            _job_queue.task_done()
+            continue
+        try:
+            # Задачу мог уже выполнить другой процесс, пока она ждала в очереди
+            current = read_job(job['id'])
+            if current is None or current.get('status') not in ('queued', 'running'):
+                continue
+            job = current
+            try:
+                JOB_HANDLERS[job['type']](job)
+                job['status'] = 'done'
+            except Exception as e:
+                print(f'Ошибка фоновой задачи {job["id"]}: {e}')
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            try:
+                save_job(job)
+            except Exception as e:
+                print(f'Ошибка сохранения задачи {job["id"]}: {e}')
+        finally:
+            try:
+                release_job(job['id'])
+            except Exception as e:
+                print(f'Ошибка снятия аренды задачи {job["id"]}: {e}')
+            _job_queue.task_done()
+
+# Запуск потоков-обработчиков (один раз на процесс): при старте сервера
+# и, для WSGI-серверов, на первом запросе
+def start_job_workers():
+    if _job_workers:
+        return
+    with _jobs_lock:
+        if _job_workers:
+            return
+        for i in range(max(1, INGEST_WORKERS)):
+            worker = threading.Thread(target=job_worker, name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            _job_workers.append(worker)
+        keeper = threading.Thread(target=job_lease_keeper, name='job-lease-keeper', daemon=True)
+        keeper.start()
+        _job_workers.append(keeper)
+    # Задачи, не завершенные до перезапуска
+    enqueue_pending_jobs()
+    prune_finished_jobs()
+
+def submit_job(job_type, **params):
+    start_job_workers()
+    job = {
+        'id': uuid.uuid4().hex,
+        'type': job_type,
+        'status': 'queued',
+        'progress': {'step': None, 'done': 0, 'total': 0},
+        'error': None,
+        'created_at': time.time(),
+        **params
+    }
+    save_job(job)
+    enqueue_job(job)
+    return job
 
 # Проверка авторизации админа
 def admin_required(f):
@@ -1073,130 +2469,205 @@ def public_books():
 # API: Получить все книги (публичный доступ)
 @app.route('/api/books', methods=['GET'])
 def get_books():
-    # Загружаем книги из папки books
-    books = []
-    if os.path.exists(BOOKS_DIR):
-        for filename in os.listdir(BOOKS_DIR):
-            if filename.endswith('.json'):
-                file_path = os.path.join(BOOKS_DIR, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        book = json.load(f)
-                        books.append(book)
-                except Exception as e:
-                    print(f'Ошибка чтения файла {filename}: {e}')
-    
-    # Поиск по запросу
-    search_query = request.args.get('search', '').lower()
+    # Параметры: search, sort, limit, cursor, fields
+    search_query = request.args.get('search', '').strip()
+    sort = request.args.get('sort', '').strip()
+    limit = request.args.get('limit', '').strip()
+    cursor = request.args.get('cursor', '').strip()
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    
+    if sort and sort.lstrip('-') not in BOOK_SORT_KEYS:
+        return jsonify({'error': f'Неизвестная сортировка: {sort}. Доступны: title, author, added_at'}), 400
+    
+    try:
+        offset = int(cursor) if cursor else 0
+        limit = int(limit) if limit else None
+    except ValueError:
+        return jsonify({'error': 'limit и cursor должны быть целыми числами'}), 400
+    if offset < 0 or (limit is not None and not 1 <= limit <= MAX_BOOKS_PAGE_SIZE):
+        return jsonify({'error': f'limit должен быть от 1 до {MAX_BOOKS_PAGE_SIZE}, cursor — не меньше 0'}), 400
+    
+    # Поиск по запросу (через индекс) или весь каталог из памяти
     if search_query:
-        filtered_books = []
-        for book in books:
-            title = book.get('title', '').lower()
-            author = book.get('author', '').lower()
-            genre = book.get('genre', '').lower()
-            description = book.get('description', '').lower()
-            
-            if (search_query in title or 
-                search_query in author or 
-                search_query in genre or 
-                search_query in description):
-                filtered_books.append(book)
-        books = filtered_books
+        books = search_books(search_query)
+        if sort:
+            books = sort_books(books, sort)
+    elif sort:
+        books = get_sorted_catalog(sort)
+    else:
+        books = list(get_catalog().values())
+    
+    total = len(books)
+    if limit is not None or offset:
+        end = offset + limit if limit is not None else total
+        page = books[offset:end]
+        next_cursor = str(end) if end < total else None
+    else:
+        page = books
+        next_cursor = None
     
-    return jsonify(books)
+    if fields:
+        fields = ['id'] + [f for f in fields if f != 'id']
+        page = [project_book(book, fields) for book in page]
+    
+    # Ответ — по-прежнему массив; данные пагинации передаются в заголовках
+    response = jsonify(page)
+    response.headers['X-Total-Count'] = str(total)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 # API: Получить текст книги для чтения
 @app.route('/api/books/<path:book_id>/text')
 def get_book_text(book_id):
     try:
-        from urllib.parse import unquote
-        book_id = unquote(book_id)
-        # Убираем лишние кавычки, если они есть
-        book_id = book_id.strip('"').strip("'").strip()
-        
-        print(f"Запрос текста книги для ID: {book_id}")
-        print(f"BOOKS_DIR: {BOOKS_DIR}")
+        book_id = clean_book_id(book_id)
+        book_data, book_file = resolve_book(book_id)
         
-        # Проверяем существование папки
-        if not os.path.exists(BOOKS_DIR):
-            print(f"Папка {BOOKS_DIR} не существует")
-            return jsonify({'error': f'Папка книг не найдена: {BOOKS_DIR}'}), 404
+        if not book_file:
+            error_msg = f'Файл книги не найден. ID: {book_id}, Папка: {BOOKS_DIR}'
+            print(error_msg)
+            return jsonify({'error': error_msg}), 404
         
-        # Ищем файл метаданных
-        meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
-        print(f"Проверка метаданных: {meta_path}, существует: {os.path.exists(meta_path)}")
+        if not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+            return jsonify({'error': f'Файл книги не найден. ID: {book_id}, Папка: {BOOKS_DIR}'}), 404
         
-        if os.path.exists(meta_path):
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                book_data = json.load(f)
-                book_file = book_data.get('book_file')
-                print(f"Найдены метаданные, book_file: {book_file}")
-                
-                if book_file:
-                    file_path = os.path.join(BOOKS_DIR, book_file)
-                    print(f"Путь к файлу: {file_path}, существует: {os.path.exists(file_path)}")
-                    if os.path.exists(file_path):
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            text = f.read()
-                        print(f"Файл прочитан, размер текста: {len(text)} символов")
-                        return jsonify({
-                            'text': text,
-                            'title': book_data.get('title', 'Книга'),
-                            'author': book_data.get('author', 'Неизвестен')
-                        })
+        # ?format=text — просто текст, иначе JSON
+        if request.args.get('format') == 'text':
+            body, content_type = 'text', 'text/plain; charset=utf-8'
+        else:
+            body, content_type = 'json', 'application/json; charset=utf-8'
         
-        # Также проверяем файл напрямую (book_id может быть именем файла)
-        book_file_path = os.path.join(BOOKS_DIR, book_id)
-        print(f"Проверка прямого пути: {book_file_path}, существует: {os.path.exists(book_file_path)}")
+        # Заранее сжатый вариант, если клиент поддерживает gzip/brotli
+        response = send_compressed_book(book_id, book_file, book_data, body, content_type)
+        if response is not None:
+            return response
         
-        if os.path.exists(book_file_path) and not book_file_path.endswith('.json'):
-            with open(book_file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-            print(f"Файл прочитан напрямую, размер: {len(text)} символов")
-            return jsonify({
-                'text': text,
-                'title': book_id.replace('.txt', '').replace('.TXT', ''),
-                'author': 'Неизвестен'
-            })
+        file_path = os.path.join(BOOKS_DIR, book_file)
+        title, author = book_display_info(book_data, book_id)
+        signature = book_file_signature(file_path)
+        cache_key = (book_id, body, signature['size'], signature['mtime_ns'], title, author)
         
-        # Ищем по всем файлам в папке
-        print(f"Поиск по всем файлам в {BOOKS_DIR}")
-        files_in_dir = os.listdir(BOOKS_DIR) if os.path.exists(BOOKS_DIR) else []
-        print(f"Файлы в папке: {files_in_dir}")
+        # Популярные книги отдаются из кэша (файл не открывается); книги крупнее лимита — потоком
+        cached = text_cache_get(cache_key)
+        if cached is not None:
+            response = Response(cached, content_type=content_type)
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
         
-        for filename in files_in_dir:
-            if filename.endswith('.json'):
-                file_path = os.path.join(BOOKS_DIR, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        book_data = json.load(f)
-                    print(f"Проверка файла {filename}, ID в данных: {book_data.get('id')}")
-                    if book_data.get('id') == book_id:
-                        book_file = book_data.get('book_file')
-                        if book_file:
-                            book_file_path = os.path.join(BOOKS_DIR, book_file)
-                            if os.path.exists(book_file_path):
-                                with open(book_file_path, 'r', encoding='utf-8') as f:
-                                    text = f.read()
-                                print(f"Найдена книга по ID, размер текста: {len(text)}")
-                                return jsonify({
-                                    'text': text,
-                                    'title': book_data.get('title', 'Книга'),
-                                    'author': book_data.get('author', 'Неизвестен')
-                                })
-                except Exception as e:
-                    print(f"Ошибка при чтении {filename}: {e}")
-                    continue
+        f = open_book_source(file_path)
+        if body == 'text':
+            chunks = iter_book_bytes(f)
+        else:
+            chunks = iter_book_text_json(f, title, author)
         
-        error_msg = f'Файл книги не найден. ID: {book_id}, Папка: {BOOKS_DIR}'
-        print(error_msg)
-        return jsonify({'error': error_msg}), 404
+        if signature['size'] <= BOOK_TEXT_CACHE_MAX_ITEM_BYTES:
+            data = b''.join(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8') for chunk in chunks)
+            text_cache_put(cache_key, data)
+            response = Response(data, content_type=content_type)
+        else:
+            response = Response(chunks, content_type=content_type)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         print(f"Исключение в get_book_text: {error_trace}")
         return jsonify({'error': f'Ошибка: {str(e)}', 'traceback': error_trace}), 500
 
+# API: Часть текста книги по абзацам (?offset=0&limit=50 или ?chapter=N&limit=50)
+@app.route('/api/books/<path:book_id>/paragraphs')
+def get_book_paragraphs(book_id):
+    book_id = clean_book_id(book_id)
+    book_data, book_file = resolve_book(book_id)
+    if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+        return jsonify({'error': f'Файл книги не найден. ID: {book_id}'}), 404
+    
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'offset и limit должны быть целыми числами'}), 400
+    if offset < 0 or not 1 <= limit <= MAX_PARAGRAPHS_PAGE_SIZE:
+        return jsonify({'error': f'limit должен быть от 1 до {MAX_PARAGRAPHS_PAGE_SIZE}, offset — не меньше 0'}), 400
+    
+    paragraphs = get_paragraph_index(book_id, book_file)
+    
+    # Переход к главе из оглавления (номер главы с 0)
+    chapter = request.args.get('chapter')
+    if chapter is not None:
+        chapters = get_toc_index(book_id, book_file)
+        try:
+            chapter_number = int(chapter)
+            if chapter_number < 0:
+                raise IndexError(chapter_number)
+            offset = chapters[chapter_number]['paragraph']
+        except (ValueError, IndexError):
+            return jsonify({'error': f'Глава {chapter} не найдена. Всего глав: {len(chapters)}'}), 404
+    
+    title, author = book_display_info(book_data, book_id)
+    return jsonify({
+        'title': title,
+        'author': author,
+        'offset': offset,
+        'limit': limit,
+        'total': len(paragraphs),
+        'paragraphs': read_paragraphs(book_file, paragraphs, offset, limit)
+    })
+
+# API: Оглавление книги
+@app.route('/api/books/<path:book_id>/toc')
+def get_book_toc(book_id):
+    book_id = clean_book_id(book_id)
+    book_data, book_file = resolve_book(book_id)
+    if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+        return jsonify({'error': f'Файл книги не найден. ID: {book_id}'}), 404
+    
+    title, author = book_display_info(book_data, book_id)
+    return jsonify({
+        'title': title,
+        'author': author,
+        'chapters': get_toc_index(book_id, book_file)
+    })
+
+# API: Количество страниц книги
+@app.route('/api/books/<path:book_id>/pages')
+def get_book_pages_info(book_id):
+    book_id = clean_book_id(book_id)
+    book_data, book_file = resolve_book(book_id)
+    if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+        return jsonify({'error': f'Файл книги не найден. ID: {book_id}'}), 404
+    
+    paragraphs, pages = get_page_index(book_id, book_file)
+    title, author = book_display_info(book_data, book_id)
+    return jsonify({
+        'title': title,
+        'author': author,
+        'words_per_page': BOOK_WORDS_PER_PAGE,
+        'total_pages': len(pages)
+    })
+
+# API: Одна страница книги (нумерация с 1)
+@app.route('/api/books/<path:book_id>/pages/<int:page_number>')
+def get_book_page(book_id, page_number):
+    book_id = clean_book_id(book_id)
+    book_data, book_file = resolve_book(book_id)
+    if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+        return jsonify({'error': f'Файл книги не найден. ID: {book_id}'}), 404
+    
+    paragraphs, pages = get_page_index(book_id, book_file)
+    if not 1 <= page_number <= len(pages):
+        return jsonify({'error': f'Страница {page_number} не найдена. Всего страниц: {len(pages)}'}), 404
+    
+    title, author = book_display_info(book_data, book_id)
+    return jsonify({
+        'title': title,
+        'author': author,
+        'page': page_number,
+        'total_pages': len(pages),
+        'paragraphs': read_page(book_file, paragraphs, pages[page_number - 1])
+    })
+
 # API: Страница чтения книги
 @app.route('/read')
 def read_book():
@@ -1206,66 +2677,34 @@ def read_book():
 @app.route('/api/books/<path:book_id>/download')
 def download_book(book_id):
     try:
-        # Ищем файл метаданных (book_id уже содержит формат, например "название.txt")
-        # Декодируем book_id (он может быть URL-encoded)
-        from urllib.parse import unquote
-        book_id = unquote(book_id)
-        # Убираем лишние кавычки, если они есть
-        book_id = book_id.strip('"').strip("'").strip()
-        
-        meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
-        
-        if os.path.exists(meta_path):
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                book_data = json.load(f)
-                book_file = book_data.get('book_file')
-                
-                if book_file:
-                    file_path = os.path.join(BOOKS_DIR, book_file)
-                    if os.path.exists(file_path):
-                        # Открываем файл в браузере, а не скачиваем
-                        response = send_from_directory(BOOKS_DIR, book_file, as_attachment=False)
-                        # Устанавливаем правильный Content-Type для текстовых файлов
-                        if book_file.endswith('.txt'):
-                            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-                        return response
-                    else:
-                        # Если файл не найден по имени из метаданных, пробуем найти по ID
-                        # (возможно, файл был сохранен с другим именем)
-                        pass
-        
-        # Также проверяем, может быть файл сам по себе (book_id = название.txt)
-        book_file_path = os.path.join(BOOKS_DIR, book_id)
-        if os.path.exists(book_file_path) and not book_file_path.endswith('.json'):
-            # Открываем файл в браузере, а не скачиваем
-            response = send_from_directory(BOOKS_DIR, book_id, as_attachment=False)
-            if book_id.endswith('.txt'):
-                response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-            return response
-        
-        # Пробуем найти все файлы в папке books и найти подходящий
-        if os.path.exists(BOOKS_DIR):
-            # Ищем метаданные по всем файлам
-            for filename in os.listdir(BOOKS_DIR):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(BOOKS_DIR, filename)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            book_data = json.load(f)
-                            if book_data.get('id') == book_id:
-                                book_file = book_data.get('book_file')
-                                if book_file:
-                                    book_file_path = os.path.join(BOOKS_DIR, book_file)
-                                    if os.path.exists(book_file_path):
-                                        # Открываем файл в браузере, а не скачиваем
-                                        response = send_from_directory(BOOKS_DIR, book_file, as_attachment=False)
-                                        if book_file.endswith('.txt'):
-                                            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-                                        return response
-                    except Exception:
-                        continue
-        
-        return jsonify({'error': 'Файл книги не найден'}), 404
+        # book_id уже содержит формат, например "название.txt"
+        book_id = clean_book_id(book_id)
+        book_data, book_file = resolve_book(book_id)
+        
+        if not book_file or not os.path.exists(os.path.join(BOOKS_DIR, book_file)):
+            return jsonify({'error': 'Файл книги не найден'}), 404
+        
+        # Строгий ETag по содержимому: повторные и докачиваемые запросы
+        # (If-None-Match, Range + If-Range) получают 304 или 206
+        etag = get_book_hash(book_id, book_file)
+        
+        # Заранее сжатый вариант, если клиент поддерживает gzip/brotli
+        if book_file.endswith('.txt'):
+            response = send_compressed_book(book_id, book_file, book_data, 'text',
+                                            'text/plain; charset=utf-8', etag=etag)
+            if response is not None:
+                return response
+        
+        # Открываем файл в браузере, а не скачиваем
+        response = send_from_directory(BOOKS_DIR, book_file, as_attachment=False, etag=etag)
+        # Устанавливаем правильный Content-Type для текстовых файлов
+        if book_file.endswith('.txt'):
+            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    except HTTPException:
+        # Например, 416 для недопустимого Range
+        raise
     except Exception as e:
         import traceback
         return jsonify({'error': f'Ошибка: {str(e)}', 'traceback': traceback.format_exc()}), 500
@@ -1286,6 +2725,143 @@ def create_book_filename(title, file_format='txt'):
     # Добавляем формат
     return f"{filename}.{file_format}"
 
+# API: Статус фоновой задачи (только для админа)
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@admin_required
+def get_job(job_id):
+    job = read_job(secure_filename(job_id))
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job)
+
+# API: Массовый импорт книг из ZIP-архива (только для админа).
+# Архив и необязательный манифест сохраняются, импорт идет фоновой задачей
+@app.route('/api/books/import', methods=['POST'])
+@admin_required
+def import_books():
+    archive = request.files.get('archive')
+    if not archive or not archive.filename:
+        return jsonify({'error': 'Нужен ZIP-архив с книгами (поле archive)'}), 400
+    manifest = request.files.get('manifest')
+    if manifest and manifest.filename and manifest.filename.rsplit('.', 1)[-1].lower() not in ('csv', 'json'):
+        return jsonify({'error': 'Манифест должен быть в формате CSV или JSON'}), 400
+    
+    upload_dir = tempfile.mkdtemp(prefix='import-', dir=JOBS_DIR)
+    try:
+        archive_path = os.path.join(upload_dir, 'books.zip')
+        archive.save(archive_path)
+        if not zipfile.is_zipfile(archive_path):
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            return jsonify({'error': 'Файл не является ZIP-архивом'}), 400
+        manifest_path = None
+        if manifest and manifest.filename:
+            manifest_path = os.path.join(upload_dir, 'manifest.' + manifest.filename.rsplit('.', 1)[-1].lower())
+            manifest.save(manifest_path)
+    except Exception as e:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return jsonify({'error': f'Ошибка сохранения файла: {e}'}), 500
+    
+    job = submit_job('bulk_import', source=archive_path, manifest=manifest_path, upload_dir=upload_dir,
+                     added_by=session.get('username', 'admin'))
+    return jsonify({'message': 'Импорт запущен', 'job_id': job['id']}), 202
+
+# API: Начать загрузку книги по частям (только для админа)
+@app.route('/api/uploads', methods=['POST'])
+@admin_required
+def init_upload():
+    data = request.json or {}
+    filename = os.path.basename(str(data.get('filename', '')).strip())
+    size = data.get('size')
+    sha256 = data.get('sha256') or None
+    
+    if not allowed_file(filename, ALLOWED_BOOK_EXTENSIONS):
+        return jsonify({'error': 'Недопустимый формат файла книги'}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({'error': 'size должен быть положительным числом'}), 400
+    if size > MAX_CHUNKED_UPLOAD_SIZE:
+        return jsonify({'error': f'Файл больше {MAX_CHUNKED_UPLOAD_SIZE} байт'}), 413
+    if sha256 is not None and not re.fullmatch(r'[0-9a-f]{64}', str(sha256).lower()):
+        return jsonify({'error': 'sha256 должен быть hex-строкой из 64 символов'}), 400
+    
+    cleanup_expired_uploads()
+    upload = create_upload(filename, size, sha256 and sha256.lower(), session.get('username', 'admin'))
+    return jsonify(get_upload_status(upload)), 201
+
+# API: Состояние загрузки (какие части уже приняты)
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@admin_required
+def get_upload(upload_id):
+    upload = read_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    return jsonify(get_upload_status(upload))
+
+# API: Принять часть n; тело запроса - байты части, X-Chunk-SHA256 - ее sha256
+@app.route('/api/uploads/<upload_id>/chunks/<int:n>', methods=['PUT'])
+@admin_required
+def put_upload_chunk(upload_id, n):
+    upload = read_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    if n >= upload['total_chunks']:
+        return jsonify({'error': f'Номер части должен быть меньше {upload["total_chunks"]}'}), 400
+    chunk_sha256 = request.headers.get('X-Chunk-SHA256', '').strip().lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', chunk_sha256):
+        return jsonify({'error': 'Нужен заголовок X-Chunk-SHA256'}), 400
+    
+    try:
+        write_upload_chunk(upload, n, request.stream, chunk_sha256)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'chunk': n, 'sha256': chunk_sha256})
+
+# API: Завершить загрузку и создать книгу (те же поля, что и у POST /api/books)
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@admin_required
+def finalize_upload(upload_id):
+    upload = read_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    missing = get_upload_status(upload)['missing']
+    if missing:
+        return jsonify({'error': 'Не все части загружены', 'missing': missing}), 409
+    
+    data = request.json if request.is_json else request.form
+    data_path = os.path.join(get_upload_dir(upload_id), 'data.part')
+    if upload['sha256'] and hash_book_file(data_path) != upload['sha256']:
+        return jsonify({'error': 'Контрольная сумма файла не совпадает'}), 400
+    
+    # Собранный файл переносится в хранилище книг без копирования
+    response = make_response(create_book(
+        data.get('title', '').strip(),
+        data.get('author', '').strip(),
+        data.get('genre', '').strip(),
+        data.get('description', ''),
+        data.get('cover', DEFAULT_COVER),
+        file_format=upload['file_format'],
+        book_path=data_path,
+        book_sha256=upload['sha256'] or None
+    ))
+    # Если файл уже перенесен, а книга не создалась, загрузку не продолжить - удаляем ее
+    if response.status_code < 400 or not os.path.exists(data_path):
+        remove_upload(upload_id)
+    return response
+
+# API: Отменить загрузку
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@admin_required
+def delete_upload(upload_id):
+    if read_upload(upload_id) is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    remove_upload(upload_id)
+    return jsonify({'message': 'Загрузка отменена'})
+
+# API: Статистика кэша текстов книг (только для админа)
+@app.route('/api/admin/cache-stats', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    return jsonify({'book_text': get_text_cache_stats()})
+
 # API: Вход админа
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
@@ -1340,7 +2916,7 @@ def add_book():
         author = data.get('author', '').strip()
         genre = data.get('genre', '').strip()
         description = data.get('description', '')
-        cover = data.get('cover', 'https://via.placeholder.com/150')
+        cover = data.get('cover', DEFAULT_COVER)
         book_file = None
     else:
         # Обработка FormData
@@ -1348,7 +2924,7 @@ def add_book():
         author = request.form.get('author', '').strip()
         genre = request.form.get('genre', '').strip()
         description = request.form.get('description', '')
-        cover = request.form.get('cover', 'https://via.placeholder.com/150')
+        cover = request.form.get('cover', DEFAULT_COVER)
         
         # Проверяем наличие файла
         if 'book_file' in request.files:
@@ -1360,65 +2936,104 @@ def add_book():
         else:
             book_file = None
     
-    # Валидация обязательных полей
-    if not title or not author or not genre:
-        return jsonify({'error': 'title, author и genre обязательны'}), 400
-    
     # Определяем формат файла
     if book_file and book_file.filename and allowed_file(book_file.filename, ALLOWED_BOOK_EXTENSIONS):
         file_format = book_file.filename.rsplit('.', 1)[1].lower()
     else:
         file_format = 'txt'  # По умолчанию
     
+    return create_book(title, author, genre, description, cover,
+                       book_file.stream if book_file else None, file_format)
+
+# Создать книгу: метаданные, обложка и (необязательно) содержимое из потока
+# или из готового файла book_path (он переносится в хранилище, а не копируется;
+# book_sha256 - его уже проверенная контрольная сумма).
+# Общий путь для обычной формы и для завершения загрузки по частям
+def create_book(title, author, genre, description, cover, book_stream=None, file_format='txt',
+                book_path=None, book_sha256=None):
+    # Валидация обязательных полей
+    if not title or not author or not genre:
+        return jsonify({'error': 'title, author и genre обязательны'}), 400
+    
     # ID = название книги + формат
     book_filename = create_book_filename(title, file_format)
     book_id = book_filename  # ID включает формат: название.txt
     
     # Проверяем, не существует ли уже книга с таким ID
     book_file_path = os.path.join(BOOKS_DIR, book_filename)
-    book_meta_path = os.path.join(BOOKS_DIR, book_id + '.json')
     
-    if os.path.exists(book_file_path) or os.path.exists(book_meta_path):
+    if os.path.exists(book_file_path) or storage.get_book(book_id) is not None:
         return jsonify({'error': f'Книга с названием "{title}" уже существует'}), 400
     
-    # Сохраняем файл книги, если он есть
+    # Встроенную обложку (data URI) переносим в хранилище обложек
+    try:
+        cover, cover_thumbs = store_cover(cover if cover else DEFAULT_COVER)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Сохраняем файл книги, если он есть: сначала содержимое в хранилище blob-ов
     saved_filename = None
-    if book_file and book_file.filename:
+    sha256 = None
+    if book_stream is not None or book_path is not None:
+        try:
+            if book_path is not None:
+                sha256, size, duplicate = move_book_blob(book_path, file_format, book_sha256)
+            else:
+                sha256, size, duplicate = store_book_blob(book_stream, file_format)
+        except Exception as e:
+            return jsonify({'error': f'Ошибка сохранения файла: {e}'}), 500
+    
+    # Состояние каталога перед записью в папку книг (см. catalog_put)
+    catalog_stamp = get_catalog_stamp()
+    
+    if sha256:
         try:
             # Используем book_filename напрямую, чтобы соответствовать ID
             # secure_filename может изменить имя, что приведет к несоответствию
             filename = book_filename  # Используем то же имя, что и для ID
-            file_path = os.path.join(BOOKS_DIR, filename)
-            book_file.save(file_path)
+            link_book_blob(sha256, filename, file_format)
             saved_filename = filename
+        except FileExistsError:
+            # Книгу с тем же названием успели добавить, пока загружался файл
+            return jsonify({'error': f'Книга с названием "{title}" уже существует'}), 400
         except Exception as e:
+            release_book_blob(sha256, file_format)
             return jsonify({'error': f'Ошибка сохранения файла: {e}'}), 500
     
     # Создаем метаданные о книге
-    new_book = {
-        'id': book_id,
-        'title': title,
-        'author': author,
-        'genre': genre,
-        'description': description,
-        'cover': cover if cover else 'https://via.placeholder.com/150',
-        'added_by': session.get('username', 'admin'),
-        'added_at': str(Path(__file__).stat().st_mtime),
-        'book_file': saved_filename,
-        'file_format': file_format
-    }
+    new_book = build_book_meta(book_id, title, author, genre, description, cover, cover_thumbs,
+                               session.get('username', 'admin'), saved_filename, file_format)
+    
+    # Хэш содержимого (для ETag и проверки целостности)
+    if saved_filename:
+        new_book['sha256'] = sha256
+        new_book['size'] = size
+        try:
+            remember_book_hash(book_id, saved_filename, sha256)
+        except Exception as e:
+            print(f'Ошибка сохранения хэша книги {book_id}: {e}')
     
     # Сохраняем метаданные
     try:
-        with open(book_meta_path, 'w', encoding='utf-8') as f:
-            json.dump(new_book, f, ensure_ascii=False, indent=2)
+        save_book_meta(new_book)
     except Exception as e:
         # Если ошибка сохранения метаданных, удаляем файл
-        if saved_filename and os.path.exists(os.path.join(BOOKS_DIR, saved_filename)):
-            os.remove(os.path.join(BOOKS_DIR, saved_filename))
+        if saved_filename:
+            remove_book_file(saved_filename, sha256, file_format)
         return jsonify({'error': f'Ошибка сохранения: {e}'}), 500
     
-    return jsonify({'message': 'Книга добавлена', 'id': book_id, 'book': new_book})
+    catalog_put(new_book, catalog_stamp)
+    
+    response = {'message': 'Книга добавлена', 'id': book_id, 'book': new_book}
+    
+    # Индексы, оглавление и сжатые варианты строятся в фоне; до готовности
+    # чтение работает, а недостающие индексы строятся по запросу
+    if saved_filename:
+        response['job_id'] = submit_job('ingest_book', book_id=book_id)['id']
+    
+    if saved_filename and duplicate:
+        response['deduplicated'] = True
+    return jsonify(response)
 
 # API: Удалить книгу (только для админа)
 @app.route('/api/books', methods=['DELETE'])
@@ -1430,35 +3045,20 @@ def delete_book():
     if not book_id:
         return jsonify({'error': 'ID обязателен'}), 400
     
-    # Ищем файлы книги по ID (метаданные и сам файл)
-    deleted = False
-    book_file_to_delete = None
-    
-    if os.path.exists(BOOKS_DIR):
-        # Ищем файл метаданных
-        meta_file = book_id + '.json'
-        meta_path = os.path.join(BOOKS_DIR, meta_file)
-        
-        if os.path.exists(meta_path):
-            try:
-                # Читаем метаданные, чтобы узнать имя файла книги
-                with open(meta_path, 'r', encoding='utf-8') as f:
-                    book_data = json.load(f)
-                    book_file_to_delete = book_data.get('book_file')
-                
-                # Удаляем метаданные
-                os.remove(meta_path)
-                deleted = True
-                
-                # Удаляем файл книги, если он есть
-                if book_file_to_delete:
-                    book_file_path = os.path.join(BOOKS_DIR, book_file_to_delete)
-                    if os.path.exists(book_file_path):
-                        os.remove(book_file_path)
-            except Exception as e:
-                return jsonify({'error': f'Ошибка удаления файла: {e}'}), 500
+    # Удаляем метаданные, а затем файл книги (имя файла берем из метаданных)
+    catalog_stamp = get_catalog_stamp()
+    try:
+        book_data = storage.delete_book(book_id)
+        if book_data and book_data.get('book_file'):
+            remove_book_file(book_data['book_file'], book_data.get('sha256'),
+                             book_data.get('file_format', 'txt'))
+    except Exception as e:
+        return jsonify({'error': f'Ошибка удаления файла: {e}'}), 500
     
-    if deleted:
+    if book_data is not None:
+        catalog_remove(book_id, catalog_stamp)
+        forget_book_indexes(book_id)
+        text_cache_forget(book_id)
         return jsonify({'message': 'Книга удалена'})
     
     return jsonify({'error': 'Книга не найдена'}), 404
@@ -1474,13 +3074,11 @@ def register():
         return jsonify({'error': 'Заполните все поля'}), 400
     
     # Проверяем в .env
-    env_users = get_users_from_env()
-    if any(u.get('username') == username for u in env_users):
+    if is_env_user(username):
         return jsonify({'error': 'Пользователь с таким именем уже существует в системе (.env)'}), 400
     
-    # Проверяем в файле пользователей
-    users = read_users()
-    if any(u.get('username') == username for u in users):
+    # Проверяем в хранилище пользователей
+    if get_user(username) is not None:
         return jsonify({'error': 'Пользователь уже существует'}), 400
     
     # Добавляем нового пользователя
@@ -1492,12 +3090,15 @@ def register():
         'is_admin': False,
         'has_subscription': False
     }
-    users.append(new_user)
     
-    if save_users(users):
-        return jsonify({'message': f'Пользователь {username} зарегистрирован!'})
-    else:
+    try:
+        created = create_user(new_user)
+    except Exception as e:
+        print(f'Ошибка сохранения пользователя: {e}')
         return jsonify({'error': 'Ошибка сохранения пользователя'}), 500
+    if not created:
+        return jsonify({'error': 'Пользователь уже существует'}), 400
+    return jsonify({'message': f'Пользователь {username} зарегистрирован!'})
 
 # API: Логин (для обычных пользователей)
 @app.route('/api/login', methods=['POST'])
@@ -1510,23 +3111,20 @@ def login():
         return jsonify({'error': 'Заполните все поля'}), 400
     
     # Проверяем в .env
-    env_users = get_users_from_env()
-    for user in env_users:
-        if user.get('username') == username and user.get('password') == password:
-            session['username'] = username
-            session['is_user'] = True
-            return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'env'})
+    if check_env_user_password(username, password):
+        session['username'] = username
+        session['is_user'] = True
+        return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'env'})
     
-    # Проверяем в файле пользователей
-    users = read_users()
-    for user in users:
-        if user.get('username') == username and user.get('password') == password:
-            session['username'] = username
-            session['is_user'] = True
-            return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'file'})
+    # Проверяем в хранилище пользователей
+    user = get_user(username)
+    if user is not None and user.get('password') == password:
+        session['username'] = username
+        session['is_user'] = True
+        return jsonify({'message': 'Вход выполнен успешно', 'username': username, 'source': 'file'})
     
     # Проверяем существование пользователя
-    if any(u.get('username') == username for u in env_users):
+    if is_env_user(username):
         return jsonify({'error': 'Неверный пароль'}), 401
     
     return jsonify({'error': 'Пользователь не найден'}), 401
@@ -1534,79 +3132,112 @@ def login():
 # API: Настройки
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
-    db = read_db()
-    settings = db.get('settings', {'background': None, 'backgroundType': 'default'})
-    backgrounds = get_available_backgrounds()
-    
-    # Добавляем стандартные фоны
-    backgrounds_list = [{
-        'name': bg,
-        'url': f'/static/backgrounds/{bg}'
-    } for bg in backgrounds]
-    
-    # Добавляем пользовательские фоны из папки
-    if os.path.exists(BACKGROUNDS_DIR):
-        for filename in os.listdir(BACKGROUNDS_DIR):
-            if allowed_file(filename, ALLOWED_IMAGE_EXTENSIONS):
-                # Проверяем, нет ли уже такого фона
-                if not any(bg['name'] == filename for bg in backgrounds_list):
-                    backgrounds_list.append({
-                        'name': filename,
-                        'url': f'/backgrounds/{filename}'
-                    })
-    
-    return jsonify({
-        'settings': settings,
-        'availableBackgrounds': backgrounds_list
-    })
+    body, etag = get_settings_payload()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Браузер хранит ответ, но каждый раз сверяет ETag (304 без тела)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # API: Сохранить настройки
 @app.route('/api/settings', methods=['POST'])
 def save_settings():
-    db = read_db()
-    
     # Проверяем, есть ли загрузка файла фона
     if 'background_file' in request.files:
         file = request.files['background_file']
         if file and file.filename and allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(BACKGROUNDS_DIR, filename)
-            file.save(file_path)
+            # Имя файла - хэш содержимого: URL можно кэшировать навсегда
+            # Расширение уже проверено allowed_file; secure_filename('фото.png') дает 'png' без точки
+            ext = file.filename.rsplit('.', 1)[1].lower()
+            filename = store_background(file.read(), ext)
+            if read_background_manifest(filename.rsplit('.', 1)[0]) is None:
+                submit_job('background_variants', filename=filename)
             
             background_url = f'/backgrounds/{filename}'
             
-            if 'settings' not in db:
-                db['settings'] = {}
-            
-            db['settings'].update({
+            settings = storage.update_settings({
                 'background': background_url,
                 'backgroundType': 'custom'
             })
+            forget_settings_payload()
             
-            save_db(db)
-            return jsonify({'message': 'Фон загружен и сохранен', 'settings': db['settings']})
+            return jsonify({'message': 'Фон загружен и сохранен', 'settings': settings})
         else:
             return jsonify({'error': 'Неподдерживаемый формат. Разрешены: png, jpg, jpeg, gif, svg, webp'}), 400
     else:
         # Обычное сохранение через JSON
         data = request.json if request.is_json else request.form.to_dict()
         
-        if 'settings' not in db:
-            db['settings'] = {}
-        
-        db['settings'].update({
+        settings = storage.update_settings({
             'background': data.get('background'),
             'backgroundType': data.get('backgroundType', 'default')
         })
+        forget_settings_payload()
         
-        save_db(db)
-        
-        return jsonify({'message': 'Настройки сохранены', 'settings': db['settings']})
+        return jsonify({'message': 'Настройки сохранены', 'settings': settings})
+
+# Обложки книг: имя файла содержит хэш содержимого, поэтому кэшируются навсегда
+@app.route('/covers/<filename>')
+def serve_cover(filename):
+    response = send_from_directory(COVERS_DIR, filename, max_age=COVER_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={COVER_CACHE_MAX_AGE}, immutable'
+    return response
 
-# Статические файлы фонов
+# Статические файлы фонов. Для загруженных фонов с готовыми копиями
+# отдается копия под клиента (формат по Accept, ширина по ?w= или Client Hints);
+# ?original=1 - исходный файл
 @app.route('/backgrounds/<filename>')
 def serve_background(filename):
-    return send_from_directory(BACKGROUNDS_DIR, filename)
+    background_hash = filename.rsplit('.', 1)[0]
+    manifest = read_background_manifest(background_hash) if re.fullmatch(r'[0-9a-f]{64}', background_hash) else None
+    variant = None
+    if manifest and not request.args.get('original'):
+        accept_webp = request.accept_mimetypes['image/webp'] > 0
+        variant = pick_background_variant(manifest, accept_webp, get_requested_background_width())
+    
+    if variant:
+        response = send_from_directory(BACKGROUND_VARIANTS_DIR, variant['file'])
+        response.headers['Vary'] = 'Accept, Sec-CH-Viewport-Width, Sec-CH-DPR, Viewport-Width, DPR'
+    else:
+        response = send_from_directory(BACKGROUNDS_DIR, filename)
+    # Пока копии не готовы, URL не кэшируется навсегда, иначе браузер запомнит оригинал.
+    # Старые фоны без хэша в имени кэшируются навсегда только по URL с ?v=<хэш>
+    version = request.args.get('v')
+    if manifest or (version and version == get_file_fingerprint(os.path.join(BACKGROUNDS_DIR, filename),
+                                                                'background:' + filename)):
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_CACHE_MAX_AGE}, immutable'
+    return response
+
+# Статические файлы по URL с хэшем. Устаревший хэш перенаправляется на актуальный URL
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    match = re.fullmatch(r'(.+?)\.([0-9a-f]{%d})(\.[^./]+)?' % ASSET_HASH_LENGTH, filename)
+    if not match:
+        return jsonify({'error': 'Файл не найден'}), 404
+    name = match.group(1) + (match.group(3) or '')
+    fingerprint = get_manifest_fingerprint(name)
+    if fingerprint is None:
+        return jsonify({'error': 'Файл не найден'}), 404
+    if fingerprint != match.group(2):
+        return redirect(asset_url(name))
+    response = send_from_directory(app.static_folder, name, max_age=ASSET_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_CACHE_MAX_AGE}, immutable'
+    return response
+
+# Потоки фоновых задач запускаются при старте сервера; под WSGI-сервером - на первом запросе
+@app.before_request
+def ensure_job_workers():
+    start_job_workers()
+
+# Просим браузер присылать размер окна (Client Hints) для выбора копии фона:
+# на страницах и на самих фонах (новые и старые имена подсказок)
+BACKGROUND_CLIENT_HINTS = 'Sec-CH-Viewport-Width, Sec-CH-DPR, Viewport-Width, DPR'
+
+@app.after_request
+def add_client_hints(response):
+    if response.mimetype == 'text/html' or request.endpoint == 'serve_background':
+        response.headers['Accept-CH'] = BACKGROUND_CLIENT_HINTS
+    return response
 
 # API: Получить всех пользователей (только для админа)
 @app.route('/api/users', methods=['GET'])
@@ -1651,30 +3282,69 @@ def update_user(username):
     is_admin = data.get('is_admin')
     has_subscription = data.get('has_subscription')
     
-    users = read_users()
-    user_found = False
+    # Обновляем только переданные поля
+    changes = {}
+    if is_admin is not None:
+        changes['is_admin'] = is_admin
+    if has_subscription is not None:
+        changes['has_subscription'] = has_subscription
     
-    for user in users:
-        if user.get('username') == username:
-            # Обновляем только переданные поля
-            if is_admin is not None:
-                user['is_admin'] = is_admin
-            if has_subscription is not None:
-                user['has_subscription'] = has_subscription
-            user_found = True
-            break
-    
-    if not user_found:
+    try:
+        user = update_user_fields(username, changes)
+    except Exception as e:
+        print(f'Ошибка сохранения пользователя: {e}')
+        return jsonify({'error': 'Ошибка сохранения'}), 500
+    if user is None:
         return jsonify({'error': 'Пользователь не найден'}), 404
     
-    if save_users(users):
-        return jsonify({'message': 'Права пользователя обновлены', 'user': {
-            'username': username,
-            'is_admin': user.get('is_admin', False),
-            'has_subscription': user.get('has_subscription', False)
-        }})
-    else:
-        return jsonify({'error': 'Ошибка сохранения'}), 500
+    return jsonify({'message': 'Права пользователя обновлены', 'user': {
+        'username': username,
+        'is_admin': user.get('is_admin', False),
+        'has_subscription': user.get('has_subscription', False)
+    }})
+
+# Общий HTTP-клиент для внешних API: пул соединений (keep-alive между входами)
+# и повторы. GET повторяется при сбое соединения и ответах 502-504; POST -
+# только если соединение не установилось (код авторизации одноразовый)
+def create_http_session():
+    http = requests.Session()
+    retry = Retry(total=2, connect=2, read=0, status=2, backoff_factor=0.3,
+                  status_forcelist=(502, 503, 504), allowed_methods=frozenset({'GET'}),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+http_session = create_http_session()
+
+# Открытые ключи Google для проверки id_token кэшируются на срок из Cache-Control
+_google_certs_lock = threading.Lock()
+_google_certs = {'certs': None, 'expires_at': 0}
+
+def get_google_certs(force=False):
+    with _google_certs_lock:
+        if not force and _google_certs['certs'] and time.time() < _google_certs['expires_at']:
+            return _google_certs['certs']
+        response = http_session.get(GOOGLE_CERTS_URL, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        _google_certs['certs'] = response.json()
+        _google_certs['expires_at'] = time.time() + (int(match.group(1)) if match else 3600)
+        return _google_certs['certs']
+
+# Проверить подпись, срок, audience и issuer id_token; возвращает claims.
+# Если ключа из заголовка токена нет в кэше, ключи перечитываются (ротация)
+def verify_google_id_token(id_token, client_id):
+    header_segment = id_token.split('.', 1)[0]
+    header = json.loads(base64.urlsafe_b64decode(header_segment + '=' * (-len(header_segment) % 4)))
+    certs = get_google_certs()
+    if header.get('kid') not in certs:
+        certs = get_google_certs(force=True)
+    claims = google_jwt.decode(id_token, certs=certs, audience=client_id, clock_skew_in_seconds=10)
+    if claims.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f'Неверный issuer id_token: {claims.get("iss")}')
+    return claims
 
 # Google OAuth: Начало авторизации
 @app.route('/api/auth/google', methods=['GET'])
@@ -1694,7 +3364,7 @@ def google_auth():
     
     # Формируем URL для авторизации Google
     auth_url = (
-        'https://accounts.google.com/o/oauth2/v2/auth?'
+        GOOGLE_AUTH_URL + '?'
         + urlencode({
             'client_id': client_id,
             'redirect_uri': request.url_root.rstrip('/') + '/api/auth/google/callback',
@@ -1726,7 +3396,6 @@ def google_auth_callback():
         return redirect('/?error=oauth_not_configured')
     
     # Обмениваем код на токен
-    token_url = 'https://oauth2.googleapis.com/token'
     redirect_uri = request.url_root.rstrip('/') + '/api/auth/google/callback'
     
     token_data = {
@@ -1738,7 +3407,7 @@ def google_auth_callback():
     }
     
     try:
-        token_response = requests.post(token_url, data=token_data)
+        token_response = http_session.post(GOOGLE_TOKEN_URL, data=token_data, timeout=HTTP_TIMEOUT)
         token_response.raise_for_status()
         tokens = token_response.json()
         access_token = tokens.get('access_token')
@@ -1746,12 +3415,22 @@ def google_auth_callback():
         if not access_token:
             return redirect('/?error=no_token')
         
-        # Получаем информацию о пользователе
-        user_info_url = 'https://www.googleapis.com/oauth2/v2/userinfo'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        user_response = requests.get(user_info_url, headers=headers)
-        user_response.raise_for_status()
-        user_info = user_response.json()
+        # Данные пользователя берем из проверенного id_token (без запроса к userinfo)
+        user_info = None
+        if tokens.get('id_token') and google_jwt is not None:
+            try:
+                claims = verify_google_id_token(tokens['id_token'], client_id)
+                if claims.get('email') and claims.get('email_verified'):
+                    user_info = {key: claims[key] for key in ('email', 'name') if key in claims}
+            except Exception as e:
+                print(f'id_token не проверен, запрашиваем userinfo: {e}')
+        
+        # Иначе получаем информацию о пользователе у Google
+        if user_info is None:
+            headers = {'Authorization': f'Bearer {access_token}'}
+            user_response = http_session.get(GOOGLE_USERINFO_URL, headers=headers, timeout=HTTP_TIMEOUT)
+            user_response.raise_for_status()
+            user_info = user_response.json()
         
         email = user_info.get('email')
         name = user_info.get('name', email)
@@ -1760,22 +3439,20 @@ def google_auth_callback():
             return redirect('/?error=no_email')
         
         # Проверяем или создаем пользователя
-        users = read_users()
-        user_found = False
-        
-        for user in users:
-            if user.get('email') == email or user.get('username') == email:
-                user_found = True
-                # Обновляем информацию
-                user['username'] = email
-                user['email'] = email
-                user['name'] = name
-                user['auth_method'] = 'google'
-                break
+        existing = get_user_by_email(email) or get_user(email)
+        user = None
         
-        if not user_found:
+        if existing is not None:
+            # Обновляем информацию
+            user = update_user_fields(existing['username'], {
+                'username': email,
+                'email': email,
+                'name': name,
+                'auth_method': 'google'
+            })
+        if user is None:
             # Создаем нового пользователя
-            new_user = {
+            user = {
                 'username': email,
                 'email': email,
                 'name': name,
@@ -1786,8 +3463,9 @@ def google_auth_callback():
                 'has_subscription': False,
                 'auth_method': 'google'
             }
-            users.append(new_user)
-            save_users(users)
+            # Параллельный вход мог уже создать пользователя
+            if not create_user(user):
+                user = get_user(email) or user
         
         # Устанавливаем сессию
         session['username'] = email
@@ -1796,11 +3474,7 @@ def google_auth_callback():
         session['auth_method'] = 'google'
         
         # Проверяем, является ли пользователь админом
-        is_admin_user = False
-        for user in users:
-            if user.get('username') == email and user.get('is_admin'):
-                is_admin_user = True
-                break
+        is_admin_user = bool(user.get('is_admin'))
         
         # Также проверяем, является ли это админ из .env
         admin_username = os.getenv('ADMIN_USERNAME', 'admin').strip()
@@ -1820,10 +3494,12 @@ def google_auth_callback():
 
 if __name__ == '__main__':
     init_db()
+    # В режиме отладки запросы обслуживает дочерний процесс перезагрузчика
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_workers()
     print("\n" + "="*50)
     print("Сервер запущен!")
     print("Откройте браузер: http://localhost:5000")
     print("Для остановки нажмите Ctrl+C")
     print("="*50 + "\n")
     app.run(debug=True, host='127.0.0.1', port=5000)
-
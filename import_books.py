@@ -0,0 +1,40 @@
+# Массовый импорт книг из папки или ZIP-архива
+# Запуск: python import_books.py <папка или архив.zip> [--manifest manifest.csv] [--workers 4]
+import argparse
+import os
+import sys
+
+from app import bulk_import
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Массовый импорт .txt книг в библиотеку')
+    parser.add_argument('source', help='Папка или ZIP-архив с .txt файлами')
+    parser.add_argument('--manifest', help='CSV или JSON с колонками file, title, author, genre, description')
+    parser.add_argument('--workers', type=int, default=None, help='Число процессов (по умолчанию - число ядер)')
+    parser.add_argument('--added-by', default='admin', help='Кто добавил книги')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f'ОШИБКА: {args.source} не найден')
+        sys.exit(1)
+
+    def report(done, total):
+        print(f'\rОбработано: {done}/{total}', end='', flush=True)
+
+    print('=' * 50)
+    print('МАССОВЫЙ ИМПОРТ КНИГ')
+    print('=' * 50)
+    result = bulk_import(args.source, args.manifest, workers=args.workers,
+                         added_by=args.added_by, progress=report)
+    print()
+
+    for book in result['books']:
+        if book['status'] != 'added':
+            print(f"  {book['file']}: {book['status']} - {book['error']}")
+    print(f"Добавлено: {result['added']}, пропущено: {result['skipped']}, ошибок: {result['failed']}")
+    sys.exit(1 if result['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
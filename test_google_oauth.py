@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Проверка входа через Google OAuth на локальном тестовом сервере вместо Google
+# (token, certs и userinfo). Запуск: python test_google_oauth.py
+# Нужны зависимости из requirements.txt (google-auth и rsa)
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import rsa
+from google.auth import crypt, jwt
+
+CLIENT_ID = 'test-client-id'
+READ_TIMEOUT = 0.5
+
+
+# Тестовый сервер Google: считает обращения и отдает id_token, подписанный нужным ключом
+class GoogleStub:
+    def __init__(self):
+        self.keys = {}
+        self.hits = {'token': 0, 'certs': 0, 'userinfo': 0}
+        self.kid = 'key-1'
+        self.published = ['key-1']
+        self.email_verified = True
+        self.token_delay = 0
+        self.add_key('key-1')
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_key(self, kid):
+        public_key, private_key = rsa.newkeys(1024)
+        self.keys[kid] = (public_key.save_pkcs1().decode(),
+                          crypt.RSASigner.from_string(private_key.save_pkcs1().decode(), key_id=kid))
+
+    def make_id_token(self):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://accounts.google.com',
+            'aud': CLIENT_ID,
+            'iat': now,
+            'exp': now + 300,
+            'email': 'reader@example.com',
+            'email_verified': self.email_verified,
+            'name': 'Из id_token'
+        }
+        return jwt.encode(self.keys[self.kid][1], claims, key_id=self.kid).decode()
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, headers=()):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.hits['token'] += 1
+                if stub.token_delay:
+                    time.sleep(stub.token_delay)
+                self.send_json({'access_token': 'access-token', 'id_token': stub.make_id_token()})
+
+            def do_GET(self):
+                if self.path.startswith('/certs'):
+                    stub.hits['certs'] += 1
+                    self.send_json({kid: stub.keys[kid][0] for kid in stub.published},
+                                   [('Cache-Control', 'public, max-age=600')])
+                else:
+                    stub.hits['userinfo'] += 1
+                    self.send_json({'email': 'reader@example.com', 'name': 'Из userinfo'})
+
+        return Handler
+
+
+class GoogleOAuthTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = GoogleStub()
+        os.environ.update({
+            'GOOGLE_CLIENT_ID': CLIENT_ID,
+            'GOOGLE_CLIENT_SECRET': 'test-secret',
+            'GOOGLE_TOKEN_URL': cls.stub.url + '/token',
+            'GOOGLE_CERTS_URL': cls.stub.url + '/certs',
+            'GOOGLE_USERINFO_URL': cls.stub.url + '/userinfo',
+            'HTTP_READ_TIMEOUT': str(READ_TIMEOUT)
+        })
+        # Приложение создает свои файлы и папки в текущей папке
+        cls.old_cwd = os.getcwd()
+        cls.work_dir = tempfile.mkdtemp(prefix='oauth-test-')
+        os.chdir(cls.work_dir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import app
+        cls.app = app
+        cls.client = app.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.server.shutdown()
+        os.chdir(cls.old_cwd)
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.stub.kid = 'key-1'
+        self.stub.published = ['key-1']
+        self.stub.email_verified = True
+        self.stub.token_delay = 0
+        self.app._google_certs.update({'certs': None, 'expires_at': 0})
+
+    # Вход через callback; возвращает (куда редирект, имя пользователя в сессии)
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        response = self.client.get('/api/auth/google/callback?code=test-code')
+        with self.client.session_transaction() as sess:
+            return response.headers['Location'], sess.get('user_name')
+
+    def hits(self):
+        return dict(self.stub.hits)
+
+    def test_certs_fetched_once_for_two_logins(self):
+        before = self.hits()
+        self.assertEqual(self.login(), ('/', 'Из id_token'))
+        self.assertEqual(self.login(), ('/', 'Из id_token'))
+        after = self.hits()
+        self.assertEqual(after['certs'] - before['certs'], 1)
+        self.assertEqual(after['token'] - before['token'], 2)
+        self.assertEqual(after['userinfo'], before['userinfo'])
+
+    def test_unknown_kid_refreshes_certs(self):
+        self.login()
+        # Google сменил ключ: в кэше его нет, ключи перечитываются один раз
+        self.stub.add_key('key-2')
+        self.stub.published = ['key-1', 'key-2']
+        self.stub.kid = 'key-2'
+        before = self.hits()
+        self.assertEqual(self.login(), ('/', 'Из id_token'))
+        after = self.hits()
+        self.assertEqual(after['certs'] - before['certs'], 1)
+        self.assertEqual(after['userinfo'], before['userinfo'])
+
+    def test_unverified_email_falls_back_to_userinfo(self):
+        self.stub.email_verified = False
+        before = self.hits()
+        self.assertEqual(self.login(), ('/', 'Из userinfo'))
+        self.assertEqual(self.hits()['userinfo'] - before['userinfo'], 1)
+
+    def test_token_read_timeout(self):
+        self.stub.token_delay = READ_TIMEOUT * 4
+        started = time.time()
+        location, user_name = self.login()
+        elapsed = time.time() - started
+        self.assertEqual(location, '/?error=oauth_error')
+        self.assertIsNone(user_name)
+        self.assertLess(elapsed, READ_TIMEOUT * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()